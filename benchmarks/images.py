@@ -0,0 +1,435 @@
+"""
+Image processing benchmark.
+
+Run from the repository root:
+
+    python -m benchmarks.images decode   # full vs reduced-scale decoding
+    python -m benchmarks.images formats  # bytes and encode time per format
+    python -m benchmarks.images pipeline # end to end, per stage
+
+Source images are synthetic images of the sizes stores usually serve.
+The pipeline mode serves them from a local HTTP server and uploads to a
+local stand-in of the S3 API, so no network access is needed.
+"""
+import io
+import os
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+
+from http.server import (
+    BaseHTTPRequestHandler,
+    SimpleHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+
+from PIL import Image, ImageDraw, ImageFilter
+
+from muyshopper.utils import space
+from muyshopper.utils.manifest import Manifest
+from muyshopper.utils.images import (
+    BIG_W_H,
+    THUMB_W_H,
+    ImageEngine,
+    download_image,
+    download_upload_image,
+    download_valid_image_from_url,
+    encode_image,
+    encode_image_to_size,
+    load_valid_image,
+    make_thumbnail,
+    render_image,
+    resize_image,
+    supported_formats,
+)
+
+
+DEFAULT_IMAGES = 20
+DEFAULT_SEED = 1234
+SOURCE_SIZES = [(1200, 1200), (2000, 1500), (3000, 3000), (4000, 3000)]
+FORMATS_SOURCE_SIZE = (2000, 1500)
+
+# Share of the JPEG size targeted in the target-bytes rows
+TARGET_RATIO = 0.6
+
+PIPELINE_IMAGES = 5
+PIPELINE_SIZES = [(800, 800), (2000, 1500), (4000, 3000)]
+PIPELINE_FORMATS = ['jpeg', 'png', 'webp']
+PIPELINE_WORKERS = 8
+
+STAGES = ['download', 'decode', 'resize', 'encode', 'upload']
+
+
+def generate_image(size, rng, image_format='jpeg', quality=90):
+    """Create an image with shapes and noise, like a product photo."""
+    img = Image.new('RGB', size, (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+
+    for _ in range(40):
+        x0, y0 = rng.randrange(size[0]), rng.randrange(size[1])
+        x1 = x0 + rng.randrange(size[0] // 2)
+        y1 = y0 + rng.randrange(size[1] // 2)
+        color = tuple(rng.randrange(256) for _ in range(3))
+
+        if rng.random() < 0.5:
+            draw.ellipse([x0, y0, x1, y1], fill=color)
+        else:
+            draw.rectangle([x0, y0, x1, y1], fill=color)
+
+    noise = Image.effect_noise(size, 24).convert('RGB')
+    img = Image.blend(img, noise, 0.15).filter(ImageFilter.SMOOTH)
+
+    fp = io.BytesIO()
+
+    if image_format == 'png':
+        img.save(fp, format=image_format)
+    else:
+        img.save(fp, format=image_format, quality=quality)
+
+    return fp.getvalue()
+
+
+def generate_images(count, size, seed=DEFAULT_SEED, image_format='jpeg'):
+    """Create `count` images of a size."""
+    rng = random.Random(seed)
+
+    return [
+        generate_image(size, rng, image_format) for _ in range(count)
+    ]
+
+
+def process(data, draft):
+    """Decode an image and render both renditions."""
+    img = load_valid_image(data, BIG_W_H if draft else None)
+
+    render_image(img, BIG_W_H)
+    render_image(img, THUMB_W_H)
+
+
+def cpu_time(images, draft):
+    """Get CPU seconds per image."""
+    start = time.process_time()
+
+    for data in images:
+        process(data, draft)
+
+    return (time.process_time() - start) / len(images)
+
+
+def bench_decode(count):
+    """Compare full and reduced-scale decoding per source size."""
+    for size in SOURCE_SIZES:
+        images = generate_images(count, size)
+
+        full = cpu_time(images, draft=False)
+        draft = cpu_time(images, draft=True)
+
+        print('{:>4}x{:<4} full {:>6.1f} ms  draft {:>6.1f} ms  '
+              'speedup {:.1f}x'.format(
+                  size[0], size[1], full * 1e3, draft * 1e3, full / draft,
+              ))
+
+
+def encode_all(images, encode):
+    """Encode images, returning mean bytes and CPU seconds per image."""
+    start = time.process_time()
+    total = sum(len(encode(img)) for img in images)
+    elapsed = time.process_time() - start
+
+    return total / len(images), elapsed / len(images)
+
+
+def bench_formats(count):
+    """Compare bytes and encode time of every format, per rendition."""
+    sources = generate_images(count, FORMATS_SOURCE_SIZE)
+    decoded = [load_valid_image(data, BIG_W_H) for data in sources]
+
+    for name, size in [('big', BIG_W_H), ('thumb', THUMB_W_H)]:
+        images = [resize_image(img, size) for img in decoded]
+        jpeg_bytes, jpeg_time = encode_all(images, encode_image)
+        target = int(jpeg_bytes * TARGET_RATIO)
+
+        for image_format in supported_formats():
+            rows = [
+                (image_format, None),
+                ('{} <= {}B'.format(image_format, target), target),
+            ]
+
+            for label, target_bytes in rows:
+                mean_bytes, mean_time = encode_all(
+                    images,
+                    lambda img: encode_image_to_size(
+                        img, image_format, target_bytes,
+                    ) if target_bytes else encode_image(img, image_format),
+                )
+
+                print('{:<6} {:<16} {:>8.0f} B {:>+7.1f}% {:>8.1f} ms'.format(
+                    name,
+                    label,
+                    mean_bytes,
+                    (mean_bytes / jpeg_bytes - 1) * 100,
+                    mean_time * 1e3,
+                ))
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """Static file handler without request logs."""
+
+    def log_message(self, *args):
+        """Don't log requests."""
+        pass
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in of the S3 API: accepts PUT and COPY requests of
+    any key and keeps object sizes in `server.objects`.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        """Don't log requests."""
+        pass
+
+    def read_body(self):
+        """Read a plain or chunked request body."""
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = b''
+
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+
+                if not size:
+                    return body
+
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_PUT(self):
+        """Store an object, or copy one."""
+        body = self.read_body()
+        self.server.objects[self.path.split('?')[0]] = len(body)
+
+        response = b''
+
+        if self.headers.get('x-amz-copy-source'):
+            response = (
+                b'<CopyObjectResult><ETag>"0"</ETag></CopyObjectResult>'
+            )
+
+        self.send_response(200)
+        self.send_header('ETag', '"0"')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+def start_server(handler, directory=None):
+    """Serve a handler from a local thread and get its base URL."""
+    if directory:
+        server = ThreadingHTTPServer(
+            ('127.0.0.1', 0),
+            lambda *args: handler(*args, directory=directory),
+        )
+    else:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+
+    server.daemon_threads = True
+    server.objects = {}
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, 'http://{}:{}'.format(*server.server_address)
+
+
+def write_sources(directory, count):
+    """Write source images of every size and format, get their names."""
+    names = []
+
+    for size in PIPELINE_SIZES:
+        for image_format in PIPELINE_FORMATS:
+            images = generate_images(count, size, image_format=image_format)
+
+            for index, data in enumerate(images):
+                name = '{}x{}-{}.{}'.format(
+                    size[0], size[1], index, image_format,
+                )
+
+                with open(os.path.join(directory, name), 'wb') as fp:
+                    fp.write(data)
+
+                names.append(name)
+
+    return names
+
+
+def time_stages(urls):
+    """Run every stage of the in-memory path, get seconds per stage."""
+    seconds = dict.fromkeys(STAGES, 0)
+
+    for url in urls:
+        start = time.perf_counter()
+        data = download_image(url)
+        seconds['download'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        img = load_valid_image(data, BIG_W_H)
+        seconds['decode'] += time.perf_counter() - start
+
+        renditions = []
+
+        for size in [BIG_W_H, THUMB_W_H]:
+            start = time.perf_counter()
+            resized = resize_image(img, size)
+            seconds['resize'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            renditions.append(encode_image(resized))
+            seconds['encode'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+
+        for index, encoded in enumerate(renditions):
+            space.upload_fileobj_to_s3(
+                io.BytesIO(encoded), 'bench/stages/{}'.format(index),
+            )
+
+        seconds['upload'] += time.perf_counter() - start
+
+    return seconds
+
+
+def legacy_upload(url, directory, index):
+    """Process an image through the on-disk path."""
+    s3_path = 'img/big/bench/legacy-{}.jpg'.format(index)
+    path = os.path.join(directory, 'legacy-{}'.format(index))
+
+    optimized_path = download_valid_image_from_url(url, path)
+    space.upload_file_to_s3(optimized_path, s3_path)
+
+    thumb_path, thumb_s3_path = make_thumbnail(optimized_path, s3_path)
+    space.upload_file_to_s3(thumb_path, thumb_s3_path)
+
+
+def images_per_second(func, urls):
+    """Run a function over urls and get images/sec."""
+    start = time.perf_counter()
+    func(urls)
+
+    return len(urls) / (time.perf_counter() - start)
+
+
+def bench_pipeline(count, workers):
+    """Time every stage and whole image paths against local servers."""
+    with tempfile.TemporaryDirectory() as directory:
+        names = write_sources(directory, count)
+
+        source_server, source_url = start_server(QuietHandler, directory)
+        s3_server, s3_url = start_server(S3Handler)
+
+        space.S3_ENDPOINT_URL = s3_url
+        space.S3_ACCESS_ID = space.S3_ACCESS_ID or 'bench'
+        space.S3_SECRET_KEY = space.S3_SECRET_KEY or 'bench'
+        space.space_manifest = Manifest(
+            os.path.join(directory, 'manifest.tsv'),
+        )
+
+        urls = [source_url + '/' + name for name in names]
+
+        print('{} images, {} sizes x {} formats'.format(
+            len(urls), len(PIPELINE_SIZES), len(PIPELINE_FORMATS),
+        ))
+
+        seconds = time_stages(urls)
+        total = sum(seconds.values())
+
+        for stage in STAGES:
+            print('{:<10} {:>7.1f} ms/image {:>5.1f}%'.format(
+                stage,
+                seconds[stage] / len(urls) * 1e3,
+                seconds[stage] / total * 100,
+            ))
+
+        def legacy(urls):
+            for index, url in enumerate(urls):
+                legacy_upload(url, directory, index)
+
+        def in_memory(urls):
+            for index, url in enumerate(urls):
+                download_upload_image(
+                    url, 'img/big/bench/{}.jpg'.format(index), True,
+                )
+
+        def engine(urls):
+            jobs = [
+                (url, 'img/big/bench/engine-{}.jpg'.format(index), True)
+                for index, url in enumerate(urls)
+            ]
+
+            with ImageEngine(workers=workers) as image_engine:
+                for result in image_engine.run(jobs):
+                    if result.error is not None:
+                        raise result.error
+
+        for label, func in [
+            ('on disk', legacy),
+            ('in memory', in_memory),
+            ('engine x{}'.format(workers), engine),
+        ]:
+            print('{:<12} {:>7.1f} images/sec'.format(
+                label, images_per_second(func, urls),
+            ))
+
+        source_server.shutdown()
+        s3_server.shutdown()
+
+    # Kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print('peak RSS {:.1f} MB, {} objects uploaded'.format(
+        peak / 1024, len(s3_server.objects),
+    ))
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Image benchmark')
+
+    parser.add_argument(
+        'mode',
+        nargs='?',
+        default='decode',
+        choices=['decode', 'formats', 'pipeline'],
+        help='What to run'
+    )
+
+    parser.add_argument(
+        '-n', '--count',
+        type=int,
+        help='Number of images per size (and format)'
+    )
+
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=PIPELINE_WORKERS,
+        help='Number of image engine workers'
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.mode == 'decode':
+        bench_decode(args.count or DEFAULT_IMAGES)
+    elif args.mode == 'formats':
+        bench_formats(args.count or DEFAULT_IMAGES)
+    elif args.mode == 'pipeline':
+        bench_pipeline(args.count or PIPELINE_IMAGES, args.workers)
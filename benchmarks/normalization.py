@@ -0,0 +1,388 @@
+"""
+Normalization benchmark and regression corpus.
+
+Run from the repository root:
+
+    python -m benchmarks.normalization fields    # ns/call per field
+    python -m benchmarks.normalization items     # normalize_items speedup
+    python -m benchmarks.normalization columns   # normalize_column speedup
+    python -m benchmarks.normalization record    # write golden outputs
+    python -m benchmarks.normalization check     # compare against golden
+
+The corpus is synthetic and seeded, so every run sees the same values.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+from muyshopper.utils.columns import normalize_column
+from muyshopper.utils.normalization import (
+    field_to_normalize_function,
+    normalize_field_value,
+    normalize_items,
+    parse_contains_string,
+    find_boolean_in_string,
+    find_float_in_string,
+    find_integer_in_string,
+    find_integer_measure_in_string,
+    find_join_integer_in_string,
+    find_measure_in_string,
+    UNITS,
+)
+
+
+DEFAULT_VALUES = 200
+DEFAULT_GOLDEN_VALUES = 50
+DEFAULT_ITEMS = 20000
+DEFAULT_ROWS = 200000
+DEFAULT_SEED = 1234
+
+GOLDEN_PATH = os.path.join(
+    os.path.dirname(__file__), 'golden', 'normalization.json',
+)
+
+ACCENTS = str.maketrans('aeiou', 'áéíóú')
+
+NOISE_VALUES = ['', '-', 'N/A', 'No especifica', 'Consultar', 'Otro']
+
+BOOLEAN_VALUES = [
+    'Si', 'Sí', 'SI', 'si', 'No', 'NO', 'no', 'True', 'false',
+    'Sí, incluye', 'No posee', 'Si tiene', 'Incluye', 'No aplica',
+]
+
+RESOLUTION_VALUES = [
+    '1920 x 1080', '1920x1080', '1366 x 768', '1366x768 px',
+    '3840 × 2160', 'Full HD (1920 x 1080)', 'HD Ready', '4K UHD',
+]
+
+NUMBER_UNITS = [
+    '', ' cm', ' kg', ' W', 'W', '"', ' pulgadas', ' GB', ' mAh',
+    ' frigorías', ' rpm', ' l', ' litros', ' GHz', ' MP',
+]
+
+# Values that once normalized wrong, always in the corpus
+EDGE_VALUES = {
+    'peso': ['0.750 kg', '4 g', '24.5g', '1.234,5 kg'],
+    'pantalla': ['27.668in', '4K 55 pulgadas', '139 cm'],
+    'potencia': ['78.342watt', '2,2 kW', '1.500.000 W', '1.500 W', '2.000 W'],
+    'memoria_ram': ['4 MB', '512mb', '1 TB'],
+    'frigorias': ['3.000 frigorias', '2.250 fg'],
+    'bateria': ['4.000 mAh', '5.000mah'],
+}
+
+TEXT_VALUES = [
+    'Intel Core i5', 'AMD Ryzen 7', 'Eléctrico', 'Turbo', 'Acero',
+    'Tambor de acero inoxidable', 'Perilla', 'Digital táctil',
+]
+
+
+def vary_text(rng, text):
+    """Change case and accents of a text."""
+    variant = rng.randrange(5)
+
+    if variant == 0:
+        return text.upper()
+    elif variant == 1:
+        return text.title()
+    elif variant == 2:
+        return text.translate(ACCENTS)
+    else:
+        return text
+
+
+def number_text(rng, integer=False):
+    """Create a number written with Spanish or plain separators."""
+    whole = rng.choice([
+        rng.randint(1, 9), rng.randint(10, 99), rng.randint(100, 999),
+        rng.randint(1000, 99999),
+    ])
+    variant = rng.randrange(5)
+
+    if integer or variant == 0:
+        return str(whole)
+    elif variant == 1:
+        return '{},{}'.format(whole, rng.randint(1, 99))
+    elif variant == 2:
+        return '{}.{}'.format(whole, rng.randint(1, 9))
+    elif variant == 3 and whole >= 1000:
+        return '{:,}'.format(whole).replace(',', '.')
+    else:
+        return str(whole)
+
+
+def number_value(rng, integer=False):
+    """Create a number surrounded by words and units."""
+    return rng.choice(['', 'Aprox. ', 'Hasta ']) + \
+        number_text(rng, integer) + rng.choice(NUMBER_UNITS)
+
+
+def measure_value(rng, unit):
+    """Create a measure written in any alias of a unit."""
+    alias = rng.choice(list(UNITS[unit]))
+
+    return number_text(rng) + rng.choice(['', ' ']) + alias
+
+
+def mapping_value(rng, mapping):
+    """Create a text containing one of the keys of a mapping."""
+    key = vary_text(rng, rng.choice(list(mapping)))
+    template = rng.choice([
+        '{}', '{}', 'Tipo {}', '{} reforzado', 'Con {}', 'Modelo {} 2019',
+    ])
+
+    return template.format(key)
+
+
+def field_value(rng, field_name):
+    """Create a realistic raw value of a field."""
+    func, args = field_to_normalize_function[field_name]
+
+    if rng.random() < 0.1:
+        return rng.choice(NOISE_VALUES)
+
+    if func is find_boolean_in_string:
+        return rng.choice(BOOLEAN_VALUES)
+    elif func is find_join_integer_in_string:
+        return rng.choice(RESOLUTION_VALUES)
+    elif func is find_float_in_string:
+        return number_value(rng)
+    elif func is find_integer_in_string:
+        return number_value(rng, integer=rng.random() < 0.7)
+    elif func in (find_measure_in_string, find_integer_measure_in_string):
+        if rng.random() < 0.3:
+            return number_value(rng)
+
+        return measure_value(rng, args[0])
+    elif func is parse_contains_string:
+        return mapping_value(rng, args[0])
+    else:
+        return vary_text(rng, rng.choice(TEXT_VALUES))
+
+
+def generate_corpus(count=DEFAULT_VALUES, seed=DEFAULT_SEED):
+    """Generate `count` raw values for every mapped field."""
+    rng = random.Random(seed)
+
+    return {
+        field_name: [
+            field_value(rng, field_name) for _ in range(count)
+        ] + EDGE_VALUES.get(field_name, [])
+        for field_name in field_to_normalize_function
+    }
+
+
+def generate_items(count, seed=DEFAULT_SEED):
+    """Generate attributes dicts with a random subset of fields."""
+    rng = random.Random(seed)
+    fields = list(field_to_normalize_function)
+    items = []
+
+    for _ in range(count):
+        item_fields = rng.sample(fields, rng.randint(5, 25))
+        items.append({
+            field_name: field_value(rng, field_name)
+            for field_name in item_fields
+        })
+
+    return items
+
+
+def normalize_per_field(items):
+    """Normalize items calling `normalize_field_value` for each field."""
+    for item in items:
+        yield {
+            field_name: normalize_field_value(field_name, field_value)
+            for field_name, field_value in item.items()
+        }
+
+
+def run(func, items):
+    """Run a normalizer over items and return results and elapsed time."""
+    start = time.perf_counter()
+    results = list(func(items))
+    elapsed = time.perf_counter() - start
+
+    return results, elapsed
+
+
+def bench_fields(count, repeat=5):
+    """Report ns/call of `normalize_field_value` for every field."""
+    corpus = generate_corpus(count)
+    total_calls = 0
+    total_time = 0
+
+    for field_name, values in corpus.items():
+        start = time.perf_counter()
+
+        for _ in range(repeat):
+            for value in values:
+                normalize_field_value(field_name, value)
+
+        elapsed = time.perf_counter() - start
+        calls = len(values) * repeat
+
+        total_calls += calls
+        total_time += elapsed
+
+        print('{:<24} {:>8.0f} ns/call'.format(
+            field_name, elapsed / calls * 1e9,
+        ))
+
+    print('{:<24} {:>8.0f} ns/call'.format(
+        'TOTAL', total_time / total_calls * 1e9,
+    ))
+
+    items = generate_items(DEFAULT_ITEMS)
+    results, elapsed = run(normalize_items, items)
+
+    print('normalize_items: {:.0f} items/sec'.format(len(items) / elapsed))
+
+
+def bench_items(count):
+    """Compare `normalize_items` against the per-field path."""
+    items = generate_items(count)
+    attributes = sum(len(item) for item in items)
+
+    per_field, per_field_time = run(normalize_per_field, items)
+    batch, batch_time = run(normalize_items, items)
+
+    assert per_field == batch, 'normalize_items differs from per-field path'
+
+    print('{} items, {} attributes'.format(len(items), attributes))
+    print('normalize_field_value: {:.3f}s ({:.0f} ns/attribute)'.format(
+        per_field_time, per_field_time / attributes * 1e9,
+    ))
+    print('normalize_items:       {:.3f}s ({:.0f} ns/attribute)'.format(
+        batch_time, batch_time / attributes * 1e9,
+    ))
+    print('speedup: {:.2f}x'.format(per_field_time / batch_time))
+
+
+def bench_columns(count):
+    """Compare `normalize_column` against a scalar loop, per field type."""
+    rng = random.Random(DEFAULT_SEED)
+    fields = ['pantalla', 'puertos_usb', 'alto', 'wifi', 'color']
+
+    for field_name in fields:
+        values = [field_value(rng, field_name) for _ in range(count)]
+
+        start = time.perf_counter()
+        scalar = [
+            normalize_field_value(field_name, value) for value in values
+        ]
+        scalar_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        column = normalize_column(field_name, values)
+        column_time = time.perf_counter() - start
+
+        column = [
+            None if value is None or value != value else value
+            for value in column.astype(object).tolist()
+        ]
+        assert column == scalar, 'normalize_column differs on ' + field_name
+
+        print('{:<12} scalar {:.3f}s  column {:.3f}s  speedup {:.1f}x'.format(
+            field_name, scalar_time, column_time, scalar_time / column_time,
+        ))
+
+
+def record_golden(count, path=GOLDEN_PATH):
+    """Write corpus values and their normalized outputs."""
+    corpus = generate_corpus(count)
+
+    golden = {
+        field_name: [
+            [value, normalize_field_value(field_name, value)]
+            for value in values
+        ]
+        for field_name, values in corpus.items()
+    }
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # One field per block and one value per line, for readable diffs
+    with open(path, 'w') as fp:
+        fp.write('{\n')
+
+        for index, field_name in enumerate(sorted(golden)):
+            fp.write('{}: [\n'.format(json.dumps(field_name)))
+            fp.write(',\n'.join(
+                '  ' + json.dumps(pair, ensure_ascii=False)
+                for pair in golden[field_name]
+            ))
+            fp.write('\n]{}\n'.format(',' if index < len(golden) - 1 else ''))
+
+        fp.write('}\n')
+
+    print('Recorded {} values in {}'.format(
+        sum(len(values) for values in golden.values()), path,
+    ))
+
+
+def check_golden(path=GOLDEN_PATH):
+    """Compare current outputs against the golden ones."""
+    with open(path, 'r') as fp:
+        golden = json.load(fp)
+
+    drifted = 0
+
+    for field_name, pairs in sorted(golden.items()):
+        for value, expected in pairs:
+            output = normalize_field_value(field_name, value)
+
+            if output != expected or type(output) is not type(expected):
+                drifted += 1
+                print('{}: {!r} -> {!r} (expected {!r})'.format(
+                    field_name, value, output, expected,
+                ))
+
+    missing = set(field_to_normalize_function) - set(golden)
+
+    for field_name in sorted(missing):
+        print('{}: no golden outputs'.format(field_name))
+
+    print('{} drifted values, {} fields without golden outputs'.format(
+        drifted, len(missing),
+    ))
+
+    return drifted == 0 and not missing
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Normalization benchmark')
+
+    parser.add_argument(
+        'mode',
+        nargs='?',
+        default='fields',
+        choices=['fields', 'items', 'columns', 'record', 'check'],
+        help='What to run'
+    )
+
+    parser.add_argument(
+        '-n', '--count',
+        type=int,
+        help='Number of values per field, items or column rows'
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.mode == 'fields':
+        bench_fields(args.count or DEFAULT_VALUES)
+    elif args.mode == 'items':
+        bench_items(args.count or DEFAULT_ITEMS)
+    elif args.mode == 'columns':
+        bench_columns(args.count or DEFAULT_ROWS)
+    elif args.mode == 'record':
+        record_golden(args.count or DEFAULT_GOLDEN_VALUES)
+    elif args.mode == 'check':
+        sys.exit(0 if check_golden() else 1)
@@ -0,0 +1,250 @@
+"""
+Product matching benchmark.
+
+Run from the repository root:
+
+    python -m benchmarks.product_matching fuzzy   # exact vs fuzzy path
+    python -m benchmarks.product_matching batch   # match_products workers
+
+The catalog and titles are synthetic and seeded. Titles mention known
+models as such, with spacing/punctuation variants or with a typo, so the
+fuzzy path can be compared against the exact one at several catalog sizes.
+"""
+import os
+import json
+import time
+import random
+import pickle
+import argparse
+import tempfile
+
+from muyshopper.utils.product_matching import ProductMatcher, FUZZY_THRESHOLD
+
+
+DEFAULT_ITEMS = 5000
+DEFAULT_SEED = 1234
+CATALOG_SIZES = [1000, 10000, 100000]
+MODELS_PER_BRAND = 50
+
+SERIES = [
+    'galaxy', 'iphone', 'moto', 'redmi', 'xperia', 'optimus', 'smart tv',
+    'aspire', 'ideapad', 'pavilion', 'inspiron', 'vivobook', 'zenfone',
+]
+
+PRODUCTS = ['Celular', 'Smart TV', 'Notebook', 'Heladera', 'Tablet']
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def generate_catalog(size, seed=DEFAULT_SEED):
+    """Generate a `brand -> models` dict with about `size` models."""
+    rng = random.Random(seed)
+    data = {}
+
+    while len(data) < max(1, size // MODELS_PER_BRAND):
+        brand = ''.join(rng.choice(LETTERS) for _ in range(rng.randint(5, 9)))
+        data[brand] = [
+            '{} {}{}'.format(
+                rng.choice(SERIES),
+                rng.choice(LETTERS),
+                rng.randint(1, 999),
+            )
+            for _ in range(MODELS_PER_BRAND)
+        ]
+
+    return data
+
+
+def vary_model(rng, model):
+    """Write a model as is, with spacing variants or with a typo."""
+    variant = rng.randrange(4)
+
+    if variant == 0:
+        return model
+    elif variant == 1:
+        return model.replace(' ', '-')
+    elif variant == 2:
+        return ' '.join(model.replace(' ', ''))
+    else:
+        index = rng.randrange(len(model))
+        return model[:index] + rng.choice(LETTERS) + model[index + 1:]
+
+
+def generate_items(data, count, seed=DEFAULT_SEED):
+    """
+    Generate items with a title mentioning a model, half of them with
+    their brand and the other half with the brand only in the title.
+    """
+    rng = random.Random(seed)
+    brands = list(data)
+    items = []
+
+    for _ in range(count):
+        brand = rng.choice(brands)
+        model = rng.choice(data[brand])
+
+        items.append({
+            'marca': brand if rng.random() < 0.5 else None,
+            'modelo': None,
+            'title': '{} {} {} {}'.format(
+                rng.choice(PRODUCTS),
+                brand.title(),
+                vary_model(rng, model),
+                rng.choice(['', 'negro', '64GB', 'Full HD']),
+            ),
+            'expected': model,
+        })
+
+    return items
+
+
+def create_matcher(directory, data, **kwargs):
+    """Create a product matcher over a catalog."""
+    paths = {
+        name: os.path.join(directory, name)
+        for name in ['data.pkl', 'skip.json', 'brands.json']
+    }
+
+    with open(paths['data.pkl'], 'wb') as fp:
+        pickle.dump(data, fp)
+
+    with open(paths['skip.json'], 'w') as fp:
+        json.dump({'brands': [], 'models': []}, fp)
+
+    with open(paths['brands.json'], 'w') as fp:
+        json.dump({}, fp)
+
+    return ProductMatcher(
+        paths['data.pkl'],
+        paths['skip.json'],
+        paths['brands.json'],
+        **kwargs
+    )
+
+
+def copy_items(items):
+    """Copy items without their expected model."""
+    return [
+        {key: value for key, value in item.items() if key != 'expected'}
+        for item in items
+    ]
+
+
+def run(matcher, items):
+    """Match items one by one and return hits, correct ones and time."""
+    matched = copy_items(items)
+
+    start = time.perf_counter()
+
+    for item in matched:
+        matcher.match_product(item)
+
+    elapsed = time.perf_counter() - start
+
+    hits = sum(1 for item in matched if item['modelo'] is not None)
+    correct = sum(
+        1
+        for item, result in zip(items, matched)
+        if result['modelo'] == item['expected']
+    )
+
+    return hits, correct, elapsed
+
+
+def bench_fuzzy(count, threshold):
+    """Compare exact and fuzzy matching at several catalog sizes."""
+    with tempfile.TemporaryDirectory() as directory:
+        for size in CATALOG_SIZES:
+            data = generate_catalog(size)
+            items = generate_items(data, count)
+
+            for fuzzy_threshold in [None, threshold]:
+                matcher = create_matcher(
+                    directory,
+                    data,
+                    fuzzy_threshold=fuzzy_threshold,
+                )
+
+                # Build indexes first, matching doesn't learn known models
+                run(matcher, items)
+                hits, correct, elapsed = run(matcher, items)
+
+                print(
+                    '{:>7} models  {:<6} {:>8.0f} ns/item  '
+                    '{:>5.1f}% matched  {:>5.1f}% correct'.format(
+                        size,
+                        'exact' if fuzzy_threshold is None else 'fuzzy',
+                        elapsed / len(items) * 1e9,
+                        hits / len(items) * 100,
+                        correct / len(items) * 100,
+                    )
+                )
+
+
+def bench_batch(count, workers, threshold):
+    """Compare fuzzy `match_products` with one and several workers."""
+    data = generate_catalog(CATALOG_SIZES[-1])
+    items = generate_items(data, count)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for batch_workers in [None, workers]:
+            matcher = create_matcher(
+                directory,
+                data,
+                fuzzy_threshold=threshold,
+            )
+            matcher.match_products(
+                copy_items(items),
+                workers=batch_workers,
+                chunk_size=max(1, count // workers),
+            )
+
+            print('{} workers: {:.0f} items/sec'.format(
+                matcher.last_batch_stats['workers'],
+                matcher.last_batch_stats['items_per_second'],
+            ))
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description='Product matching benchmark')
+
+    parser.add_argument(
+        'mode',
+        nargs='?',
+        default='fuzzy',
+        choices=['fuzzy', 'batch'],
+        help='What to run'
+    )
+
+    parser.add_argument(
+        '-n', '--count',
+        type=int,
+        default=DEFAULT_ITEMS,
+        help='Number of items'
+    )
+
+    parser.add_argument(
+        '-t', '--threshold',
+        type=float,
+        default=FUZZY_THRESHOLD,
+        help='Fuzzy threshold'
+    )
+
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=os.cpu_count(),
+        help='Number of workers'
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    if args.mode == 'fuzzy':
+        bench_fuzzy(args.count, args.threshold)
+    elif args.mode == 'batch':
+        bench_batch(args.count * 20, args.workers, args.threshold)
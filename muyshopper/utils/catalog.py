@@ -0,0 +1,186 @@
+"""Brand & model catalog storage utils."""
+import os
+import pickle
+import argparse
+
+from collections.abc import MutableMapping
+
+from muyshopper.utils.sqlite import SQLiteDatabase
+
+
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS marcas (
+    id INTEGER PRIMARY KEY,
+    marca TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS modelos (
+    id INTEGER PRIMARY KEY,
+    marca TEXT NOT NULL,
+    modelo TEXT NOT NULL,
+    UNIQUE (marca, modelo)
+);
+CREATE INDEX IF NOT EXISTS modelos_marca ON modelos (marca, id);
+'''
+
+
+class PickleCatalog:
+    """Catalog stored as a pickled `brand -> models` dict."""
+
+    def __init__(self, path):
+        """Variable initialization."""
+        self.path = path
+
+    def load(self):
+        """Load the whole catalog."""
+        with open(self.path, 'rb') as fp:
+            data = pickle.load(fp)
+
+        return data
+
+    def save(self, data, marcas=None, modelos=None):
+        """Rewrite the whole catalog, the learned deltas are in `data`."""
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump(dict(data), fp)
+
+        os.replace(tmp_path, self.path)
+
+
+class CatalogData(MutableMapping):
+    """`brand -> models` mapping loading the models of a brand lazily."""
+
+    def __init__(self, catalog, marcas):
+        """Variable initialization."""
+        self.catalog = catalog
+        self._data = dict.fromkeys(marcas)
+
+    def __getitem__(self, marca):
+        """Get the models of a brand, loading them on first access."""
+        modelos = self._data[marca]
+
+        if modelos is None:
+            modelos = self._data[marca] = self.catalog.load_modelos(marca)
+
+        return modelos
+
+    def __setitem__(self, marca, modelos):
+        """Set the models of a brand."""
+        self._data[marca] = modelos
+
+    def __delitem__(self, marca):
+        """Remove a brand."""
+        del self._data[marca]
+
+    def __contains__(self, marca):
+        """Check for a brand without loading its models."""
+        return marca in self._data
+
+    def __iter__(self):
+        """Iterate over brands."""
+        return iter(self._data)
+
+    def __len__(self):
+        """Get the number of brands."""
+        return len(self._data)
+
+
+class SQLiteCatalog(SQLiteDatabase):
+    """
+    Catalog stored in a SQLite database.
+
+    Loading only reads brand names, the models of a brand are read the
+    first time they are needed. Saving only inserts the brands & models
+    learned in the run, and several processes can do it concurrently.
+    Insertion order is kept, so brands & models come back in the order
+    they were learned, as with the pickle.
+    """
+
+    schema = SQLITE_SCHEMA
+
+    def load(self):
+        """Load brand names, models are loaded lazily."""
+        cursor = self.connection.execute(
+            'SELECT marca FROM marcas ORDER BY id'
+        )
+
+        return CatalogData(self, (marca for marca, in cursor))
+
+    def load_modelos(self, marca):
+        """Load the models of a brand."""
+        cursor = self.connection.execute(
+            'SELECT modelo FROM modelos WHERE marca = ? ORDER BY id',
+            (marca,),
+        )
+
+        return [modelo for modelo, in cursor]
+
+    def save(self, data, marcas=None, modelos=None):
+        """Insert learned brands and `(brand, model)` pairs."""
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO marcas (marca) VALUES (?)',
+                ((marca,) for marca in marcas or []),
+            )
+            self.connection.executemany(
+                'INSERT OR IGNORE INTO modelos (marca, modelo) VALUES (?, ?)',
+                modelos or [],
+            )
+
+
+def get_catalog(path):
+    """Get the catalog backend for a path, based on its extension."""
+    if path.endswith(SQLITE_EXTENSIONS):
+        return SQLiteCatalog(path)
+
+    return PickleCatalog(path)
+
+
+def import_pickle(pickle_path, sqlite_path):
+    """Copy a pickled catalog into a SQLite catalog."""
+    data = PickleCatalog(pickle_path).load()
+
+    marcas = [marca for marca in data if marca is not None]
+    modelos = [
+        (marca, modelo)
+        for marca in marcas
+        for modelo in data[marca]
+        if modelo is not None
+    ]
+
+    SQLiteCatalog(sqlite_path).save(None, marcas, modelos)
+
+    return len(marcas), len(modelos)
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description='Import a pickled catalog into SQLite',
+    )
+
+    parser.add_argument(
+        '-p', '--pickle',
+        required=True,
+        help='Pickle catalog path'
+    )
+
+    parser.add_argument(
+        '-s', '--sqlite',
+        required=True,
+        help='SQLite catalog path'
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    marcas_count, modelos_count = import_pickle(args.pickle, args.sqlite)
+
+    print('Imported {} brands and {} models'.format(
+        marcas_count, modelos_count,
+    ))
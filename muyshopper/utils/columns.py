@@ -0,0 +1,169 @@
+"""Column-wise normalization utils."""
+import re
+import numpy as np
+
+from muyshopper.utils.normalization import (
+    INTEGER_UNITS,
+    NORMALIZATION_PLAN,
+    QUANTITY_RE,
+    UNITS,
+    convert_measure,
+    field_to_normalize_function,
+    find_boolean_in_string,
+    find_float_in_string,
+    find_integer_in_string,
+    find_integer_measure_in_string,
+    find_measure_in_string,
+    parse_quantity,
+)
+from muyshopper.utils.text import canonical
+
+
+# Result dtype by normalization function, anything else is `object`
+COLUMN_DTYPES = {
+    find_float_in_string: np.float64,
+    find_integer_in_string: np.int64,
+    find_measure_in_string: np.float64,
+    find_integer_measure_in_string: np.int64,
+    find_boolean_in_string: np.bool_,
+}
+
+# Quantities of values joined by NUL characters, which no quantity
+# can span, and the separators themselves to tell values apart
+VALUES_QUANTITY_RE = re.compile(r"(\0)|" + QUANTITY_RE.pattern)
+
+
+def factorize(values):
+    """
+    Split values into a list of unique values and an array of codes,
+    such that `uniques[codes[i]] == values[i]`
+    """
+    index = {}
+    codes = np.fromiter(
+        (index.setdefault(value, len(index)) for value in values),
+        dtype=np.intp,
+        count=len(values),
+    )
+
+    return list(index), codes
+
+
+def find_measures_in_strings(values, unit):
+    """
+    Batch version of `find_measure_in_string`, with a single
+    `VALUES_QUANTITY_RE` pass over all values joined by NUL characters.
+    """
+    aliases = UNITS[unit]
+    thousands = True if unit in INTEGER_UNITS else None
+
+    texts = (
+        str(value).replace('\0', ' ') if value else '' for value in values
+    )
+
+    # Same as `canonical`, skipping the transliteration of ASCII texts
+    text = '\0'.join(
+        text.lower() if text.isascii() else canonical(text) for text in texts
+    )
+
+    results = [None] * len(values)
+    fallbacks = [None] * len(values)
+    index = 0
+
+    for separator, grouped, single, plain, alias in VALUES_QUANTITY_RE.findall(
+        text,
+    ):
+        if separator:
+            index += 1
+        elif results[index] is not None:
+            continue
+        elif alias in aliases:
+            results[index] = convert_measure(
+                parse_quantity(grouped, single, plain, alias, thousands),
+                aliases[alias],
+            )
+        elif not alias and fallbacks[index] is None:
+            fallbacks[index] = (grouped, single, plain)
+
+    for index, fallback in enumerate(fallbacks):
+        if fallback is not None and results[index] is None:
+            results[index] = parse_quantity(*fallback, None, thousands)
+
+    return results
+
+
+def find_integer_measures_in_strings(values, unit):
+    """Batch version of `find_integer_measure_in_string`."""
+    return [
+        None if number is None else int(round(number))
+        for number in find_measures_in_strings(values, unit)
+    ]
+
+
+# Batch versions of normalization functions, called with the values and
+# the extra arguments of the field
+BATCH_FUNCTIONS = {
+    find_measure_in_string: find_measures_in_strings,
+    find_integer_measure_in_string: find_integer_measures_in_strings,
+}
+
+
+def get_column_dtype(field_name):
+    """Get the result dtype of a field column."""
+    func, args = field_to_normalize_function.get(field_name, (None, None))
+
+    return COLUMN_DTYPES.get(func, object)
+
+
+def normalize_column(field_name, values, plan=None):
+    """
+    Normalize a whole column of raw values of a single field.
+
+    Each distinct raw value is normalized once, and the measures of
+    measure fields are extracted in a single regex pass over all
+    distinct values. Float fields return a float64 array with NaN for
+    missing values, integer and boolean fields a masked int64/bool
+    array, and any other field an object array holding what
+    `normalize_field_value` returns.
+    """
+    if plan is None:
+        plan = NORMALIZATION_PLAN
+
+    func = plan.get(field_name)
+    dtype = get_column_dtype(field_name)
+    mapped_func, args = field_to_normalize_function.get(
+        field_name, (None, None),
+    )
+
+    uniques, codes = factorize(values)
+
+    if func is None:
+        normalized = [None] * len(uniques)
+    elif (
+        func is NORMALIZATION_PLAN.get(field_name) and
+        mapped_func in BATCH_FUNCTIONS
+    ):
+        normalized = BATCH_FUNCTIONS[mapped_func](uniques, *args)
+    else:
+        normalized = [func(value) if value else None for value in uniques]
+
+    if dtype is np.float64:
+        normalized = np.array(
+            [np.nan if value is None else value for value in normalized],
+            dtype=np.float64,
+        )
+
+        return normalized[codes]
+
+    if dtype is object:
+        column = np.empty(len(normalized), dtype=object)
+        column[:] = normalized
+
+        return column[codes]
+
+    mask = np.array([value is None for value in normalized], dtype=bool)
+    data = np.array(
+        [0 if value is None else value for value in normalized],
+        dtype=dtype,
+    )
+
+    return np.ma.masked_array(data[codes], mask=mask[codes])
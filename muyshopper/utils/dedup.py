@@ -0,0 +1,183 @@
+"""Image deduplication utils."""
+import hashlib
+import threading
+
+from PIL import Image
+
+from muyshopper.utils.sqlite import SQLITE_TIMEOUT, SQLiteDatabase
+
+
+# Side of the difference hash grid, hashes have DHASH_SIZE ** 2 bits
+DHASH_SIZE = 8
+
+# The hash is split in this many bands, so that hashes up to
+# DHASH_BANDS - 1 bits apart are sure to share a band. Each band has its
+# own column in SQLITE_SCHEMA
+DHASH_BANDS = 4
+
+# Max differing bits between near duplicate images
+DHASH_MAX_DISTANCE = DHASH_BANDS - 1
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    sha256 TEXT PRIMARY KEY,
+    s3_path TEXT NOT NULL,
+    thumbnail TEXT,
+    dhash INTEGER,
+    band0 INTEGER,
+    band1 INTEGER,
+    band2 INTEGER,
+    band3 INTEGER
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS images_band0 ON images (band0);
+CREATE INDEX IF NOT EXISTS images_band1 ON images (band1);
+CREATE INDEX IF NOT EXISTS images_band2 ON images (band2);
+CREATE INDEX IF NOT EXISTS images_band3 ON images (band3);
+'''
+
+HASH_BITS = DHASH_SIZE * DHASH_SIZE
+BAND_BITS = HASH_BITS // DHASH_BANDS
+
+
+def content_hash(data):
+    """Get the SHA-256 hex digest of image bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def dhash(img, size=DHASH_SIZE):
+    """
+    Get the difference hash of an image: one bit per pixel of a
+    `size + 1` by `size` grayscale thumbnail, set when the pixel is
+    brighter than its right neighbour. Re-encoded or resized copies
+    of an image get the same hash or one a few bits apart.
+    """
+    small = img.convert('L').resize((size + 1, size), Image.LANCZOS)
+    pixels = small.tobytes()
+
+    value = 0
+
+    for row in range(size):
+        offset = row * (size + 1)
+
+        for col in range(offset, offset + size):
+            value = (value << 1) | (pixels[col] > pixels[col + 1])
+
+    return value
+
+
+def hash_bands(value):
+    """Split a hash into DHASH_BANDS integers."""
+    mask = (1 << BAND_BITS) - 1
+
+    return [
+        (value >> (band * BAND_BITS)) & mask
+        for band in range(DHASH_BANDS)
+    ]
+
+
+def hamming_distance(a, b):
+    """Get the number of differing bits of two hashes."""
+    return bin(a ^ b).count('1')
+
+
+def to_signed(value):
+    """Fit an unsigned 64 bit hash in a SQLite integer."""
+    return value - (1 << HASH_BITS) if value >> (HASH_BITS - 1) else value
+
+
+def to_unsigned(value):
+    """Get back an unsigned 64 bit hash from a SQLite integer."""
+    return value & ((1 << HASH_BITS) - 1)
+
+
+class ImageIndex(SQLiteDatabase):
+    """
+    Persistent index of uploaded images, by content hash.
+
+    Exact copies are found by the SHA-256 of their bytes, a primary key
+    lookup. With `perceptual`, near duplicates (re-encoded, resized) are
+    found by difference hash: candidates sharing one of its bands are
+    read through the band indexes and kept if at most `max_distance`
+    bits apart, so lookups stay fast with millions of images. It's off
+    by default, as a false positive attaches another product's photo.
+    """
+
+    schema = SQLITE_SCHEMA
+
+    # Shared by engine threads, `lock` serializes its use
+    check_same_thread = False
+
+    def __init__(
+        self,
+        path,
+        perceptual=False,
+        max_distance=DHASH_MAX_DISTANCE,
+        timeout=SQLITE_TIMEOUT,
+    ):
+        """Variable initialization."""
+        super().__init__(path, timeout)
+
+        self.perceptual = perceptual
+        self.max_distance = max_distance
+
+        self.lock = threading.Lock()
+
+    def find(self, digest):
+        """Get the `{'image', 'thumbnail'}` space paths of an exact copy."""
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT s3_path, thumbnail FROM images WHERE sha256 = ?',
+                (digest,),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return {'image': row[0], 'thumbnail': row[1]}
+
+    def find_similar(self, value):
+        """Get the space paths of the closest near duplicate."""
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT s3_path, thumbnail, dhash FROM images '
+                'WHERE band0 = ? OR band1 = ? OR band2 = ? OR band3 = ?',
+                hash_bands(value),
+            ).fetchall()
+
+        best = None
+        best_distance = self.max_distance + 1
+
+        for s3_path, thumbnail, other in rows:
+            distance = hamming_distance(value, to_unsigned(other))
+
+            if distance < best_distance:
+                best = {'image': s3_path, 'thumbnail': thumbnail}
+                best_distance = distance
+
+        return best
+
+    def add(self, digest, data, value=None):
+        """Index the space paths of an image, replacing previous ones."""
+        if value is not None:
+            bands = hash_bands(value)
+        else:
+            bands = [None] * DHASH_BANDS
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO images '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    digest,
+                    data['image'],
+                    data.get('thumbnail'),
+                    to_signed(value) if value is not None else None,
+                ] + bands,
+            )
+
+    def __len__(self):
+        """Get the number of indexed images."""
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM images'
+            ).fetchone()[0]
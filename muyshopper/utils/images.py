@@ -1,20 +1,72 @@
 """MuyShopper images utils."""
+import io
 import os
-import uuid
-import shutil
+import threading
+import urllib.parse
 import requests
 
-from PIL import Image
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 
-from muyshopper.utils.space import upload_file_to_s3
+from PIL import Image, features
+
+from muyshopper.utils.dedup import content_hash, dhash
+from muyshopper.utils.space import (
+    copy_s3_object,
+    upload_fileobj_to_s3,
+)
 
 
 # Image Settings
 BIG_W_H = (500, 500)
 THUMB_W_H = (200, 200)
+MIN_W_H = (200, 200)
+
+# Transparent images are flattened on this color, as JPEG has no alpha
+BACKGROUND_COLOR = (255, 255, 255)
+
+# JPEGs are decoded at a reduced scale still at least this many times
+# bigger than their largest rendition, as `Image.thumbnail` does
+DRAFT_REDUCING_GAP = 2.0
+
+# Encoder settings by format, `quality` being the default one
+FORMAT_OPTIONS = {
+    'jpeg': {'quality': 80, 'progressive': True},
+    'webp': {'quality': 80, 'method': 4},
+    'avif': {'quality': 60, 'speed': 6},
+}
+
+FORMAT_EXTENSIONS = {'jpeg': 'jpg', 'webp': 'webp', 'avif': 'avif'}
+
+# Lowest quality tried when encoding to a target size
+MIN_QUALITY = 30
+
+# Download settings
+DOWNLOAD_CHUNK_SIZE = 16 * 1024
+
+# Bytes read looking for the image size before giving up and checking it
+# once the image is decoded
+HEADER_PROBE_BYTES = 64 * 1024
 
-# Temp folder
-TMP_FOLDER = '/tmp'
+# Image engine settings
+ENGINE_WORKERS = 16
+ENGINE_HOST_CONCURRENCY = 4
+
+# What to do with duplicates of indexed images: reuse the space paths of
+# the indexed image, or copy it to the new paths. Reused paths belong to
+# another product, so the space inventory doesn't count them for this
+# one and it gets planned again
+DEDUP_SKIP = 'skip'
+DEDUP_COPY = 'copy'
+
+# Download counters by host
+download_stats = defaultdict(Counter)
+download_stats_lock = threading.Lock()
 
 
 class LowImageQualityException(Exception):
@@ -25,34 +77,30 @@ class LowImageQualityException(Exception):
 
 def download_valid_image_from_url(url, path):
     """Download image while making sure it's big enough."""
-    r = requests.get(url, stream=True)
+    data = download_image(url)
 
-    if r.status_code == 200:
-        with open(path, 'wb') as f:
-            r.raw.decode_content = True
-            shutil.copyfileobj(r.raw, f)
+    with open(path, 'wb') as f:
+        f.write(data)
 
-        img = Image.open(path)
-        w, h = img.size
+    img = Image.open(path)
+    w, h = img.size
 
-        name, ext = os.path.splitext(path)
-        optimized_name = name + '-optimized.jpg'
+    if w < MIN_W_H[0] or h < MIN_W_H[1]:
+        raise LowImageQualityException
 
-        optimize_and_save_image(img, img.size, optimized_name)
+    name, ext = os.path.splitext(path)
+    optimized_name = name + '-optimized.jpg'
 
-        if w < 200 or h < 200:
-            raise LowImageQualityException
+    optimize_and_save_image(img, img.size, optimized_name)
 
-        return optimized_name
-    else:
-        raise Exception
+    return optimized_name
 
 
 def optimize_and_save_image(img, size, output_path, quality=80):
     """Optimize image and save it."""
     img.thumbnail(
         size,
-        resample=Image.ANTIALIAS,
+        resample=Image.LANCZOS,
     )
 
     save_args = {
@@ -67,6 +115,7 @@ def optimize_and_save_image(img, size, output_path, quality=80):
 def make_thumbnail(local_path, s3_path):
     """Create a thumbnail for a certain image."""
     img = Image.open(local_path)
+    draft_image(img, THUMB_W_H)
 
     name, ext = os.path.splitext(local_path)
     optimized_name = name + '-optimized-thumb.jpg'
@@ -75,38 +124,562 @@ def make_thumbnail(local_path, s3_path):
 
     thumbnail_s3_path = s3_path.replace('big', 'thumb')
 
-    img.save(optimized_name)
-
     return optimized_name, thumbnail_s3_path
 
 
-def download_upload_image(image_url, s3_path, thumbnail=False):
-    """Download image and upload it to the space."""
-    filename, ext = os.path.splitext(image_url)
-    tmp_path = os.path.join(TMP_FOLDER, str(uuid.uuid4()) + ext)
+def count_download(host, **counts):
+    """Add to the download counters of a host."""
+    with download_stats_lock:
+        download_stats[host].update(counts)
+
+
+def get_download_stats():
+    """
+    Get download counters by host: `downloads` and `rejected` images,
+    `bytes` read and `bytes_skipped` by rejecting images early, as long
+    as the server sent their length.
+    """
+    with download_stats_lock:
+        return {host: dict(counts) for host, counts in download_stats.items()}
+
 
-    data = {}
+def reset_download_stats():
+    """Reset download counters."""
+    with download_stats_lock:
+        download_stats.clear()
 
+
+def probe_image_size(data):
+    """Get the size of an image from its first bytes, None if unknown."""
     try:
-        optimized_path = download_valid_image_from_url(
-            image_url,
-            tmp_path,
+        with Image.open(io.BytesIO(data)) as img:
+            return img.size
+    except Exception:
+        return None
+
+
+def download_image(url, session=None):
+    """
+    Download an image into memory. Its size is read as soon as its
+    header arrives and images too small are rejected without reading
+    the rest.
+    """
+    host = urllib.parse.urlsplit(url).netloc
+    r = (session or requests).get(url, stream=True)
+
+    with r:
+        if r.status_code != 200:
+            raise Exception
+
+        data = bytearray()
+        probing = True
+
+        for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+            data += chunk
+
+            if not probing:
+                continue
+
+            size = probe_image_size(bytes(data))
+
+            if size is not None:
+                probing = False
+
+                if size[0] < MIN_W_H[0] or size[1] < MIN_W_H[1]:
+                    length = int(r.headers.get('Content-Length') or 0)
+
+                    count_download(
+                        host,
+                        rejected=1,
+                        bytes=len(data),
+                        bytes_skipped=max(0, length - len(data)),
+                    )
+
+                    raise LowImageQualityException
+
+            elif len(data) >= HEADER_PROBE_BYTES:
+                probing = False
+
+    count_download(host, downloads=1, bytes=len(data))
+
+    return bytes(data)
+
+
+def draft_image(img, size, reducing_gap=DRAFT_REDUCING_GAP):
+    """
+    Let a JPEG image that is not loaded yet decode at a reduced scale
+    (DCT scaling), keeping it `reducing_gap` times bigger than it would
+    be once resized to fit `size`. Other formats are decoded in full.
+    """
+    w, h = img.size
+    ratio = min(size[0] / w, size[1] / h)
+
+    if ratio * reducing_gap < 1:
+        img.draft(None, (
+            max(1, int(w * ratio * reducing_gap)),
+            max(1, int(h * ratio * reducing_gap)),
+        ))
+
+
+def load_valid_image(data, size=None):
+    """
+    Decode an image while making sure it's big enough. With `size`, the
+    largest size it will be resized to, JPEGs are decoded at a reduced
+    scale.
+    """
+    img = Image.open(io.BytesIO(data))
+
+    w, h = img.size
+
+    if w < MIN_W_H[0] or h < MIN_W_H[1]:
+        raise LowImageQualityException
+
+    if size:
+        draft_image(img, size)
+
+    img.load()
+
+    return img
+
+
+def supported_formats():
+    """Get the rendition formats Pillow can encode here."""
+    return [
+        image_format
+        for image_format in FORMAT_OPTIONS
+        if image_format == 'jpeg' or features.check(image_format)
+    ]
+
+
+def flatten_image(img):
+    """Get an RGB copy of an image, transparent parts on the background."""
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        img = img.convert('RGBA')
+
+        rendition = Image.new('RGB', img.size, BACKGROUND_COLOR)
+        rendition.paste(img, mask=img.getchannel('A'))
+
+        return rendition
+
+    return img.convert('RGB')
+
+
+def resize_image(img, size):
+    """Get an RGB or grayscale copy of an image resized to fit `size`."""
+    if img.mode not in ('RGB', 'L') or 'transparency' in img.info:
+        rendition = flatten_image(img)
+    elif img.width > size[0] or img.height > size[1]:
+        rendition = img.copy()
+    else:
+        return img
+
+    rendition.thumbnail(size, resample=Image.LANCZOS)
+
+    return rendition
+
+
+def encode_image(img, image_format='jpeg', quality=None):
+    """Encode an image, with the default settings of its format."""
+    options = dict(FORMAT_OPTIONS[image_format])
+
+    if quality is not None:
+        options['quality'] = quality
+
+    fp = io.BytesIO()
+    img.save(fp, format=image_format, **options)
+
+    return fp.getvalue()
+
+
+def encode_image_to_size(img, image_format, target_bytes):
+    """
+    Encode an image with the highest quality, up to the default one of
+    its format, that fits in `target_bytes`, binary searching it. Falls
+    back to `MIN_QUALITY` when nothing fits.
+    """
+    best = encode_image(img, image_format)
+
+    if len(best) <= target_bytes:
+        return best
+
+    low = MIN_QUALITY
+    high = FORMAT_OPTIONS[image_format]['quality'] - 1
+    best = None
+
+    while low <= high:
+        quality = (low + high) // 2
+        encoded = encode_image(img, image_format, quality)
+
+        if len(encoded) <= target_bytes:
+            best = encoded
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    return best or encode_image(img, image_format, MIN_QUALITY)
+
+
+def render_image(img, size, quality=80):
+    """Encode an image resized to fit `size` as an in-memory JPEG."""
+    return io.BytesIO(encode_image(resize_image(img, size), 'jpeg', quality))
+
+
+def rendition_path(s3_path, name, image_format):
+    """
+    Get the space path of a rendition from the big JPEG one. Formats
+    other than JPEG go in folders of their own, like "img/big-webp/",
+    so that the space inventory counts each image once.
+    """
+    extension = FORMAT_EXTENSIONS[image_format]
+
+    if image_format != 'jpeg':
+        name = '{}-{}'.format(name, extension)
+
+    base, ext = os.path.splitext(s3_path.replace('big', name, 1))
+
+    return base + '.' + extension
+
+
+Renditions = namedtuple('Renditions', ['big', 'thumb', 'dhash', 'extra'])
+
+
+def render_renditions(
+    data,
+    thumbnail=False,
+    perceptual=False,
+    formats=None,
+    target_bytes=None,
+):
+    """
+    Decode an image once, just big enough for the big rendition, and
+    encode the big and, optionally, thumbnail renditions from it. Each
+    size is resized once and encoded as JPEG plus any other of
+    `formats`, kept in `extra` by `(size name, format)`. `target_bytes`
+    maps size names to the bytes their renditions should fit in. With
+    `perceptual`, its difference hash is computed as well.
+    """
+    img = load_valid_image(data, BIG_W_H)
+
+    sizes = [('big', BIG_W_H)]
+
+    if thumbnail:
+        sizes.append(('thumb', THUMB_W_H))
+
+    image_formats = ['jpeg'] + [
+        image_format
+        for image_format in formats or []
+        if image_format != 'jpeg'
+    ]
+
+    encoded = {}
+
+    for name, size in sizes:
+        resized = resize_image(img, size)
+        target = (target_bytes or {}).get(name)
+
+        for image_format in image_formats:
+            if target:
+                encoded[name, image_format] = encode_image_to_size(
+                    resized, image_format, target,
+                )
+            else:
+                encoded[name, image_format] = encode_image(
+                    resized, image_format,
+                )
+
+    return Renditions(
+        encoded['big', 'jpeg'],
+        encoded.get(('thumb', 'jpeg')),
+        dhash(img) if perceptual else None,
+        {key: value for key, value in encoded.items() if key[1] != 'jpeg'},
+    )
+
+
+def upload_renditions(big, thumb, s3_path, extra=None):
+    """
+    Upload renditions and get their space paths. Those of `extra`
+    renditions go in `formats`, as `{format: {'image', 'thumbnail'}}`.
+    """
+    upload_fileobj_to_s3(io.BytesIO(big), s3_path, content_type='image/jpeg')
+
+    data = {'image': s3_path}
+
+    if thumb is not None:
+        thumb_s3_path = s3_path.replace('big', 'thumb')
+
+        upload_fileobj_to_s3(
+            io.BytesIO(thumb), thumb_s3_path, content_type='image/jpeg',
         )
 
-        upload_file_to_s3(optimized_path, s3_path)
+        data['thumbnail'] = thumb_s3_path
 
-        data['image'] = s3_path
+    for (name, image_format), encoded in (extra or {}).items():
+        path = rendition_path(s3_path, name, image_format)
 
-        if thumbnail:
-            thumb_path, thumb_s3_path = make_thumbnail(
-                optimized_path,
-                s3_path,
-            )
+        upload_fileobj_to_s3(
+            io.BytesIO(encoded), path, content_type='image/' + image_format,
+        )
+
+        key = 'image' if name == 'big' else 'thumbnail'
+        data.setdefault('formats', {}).setdefault(image_format, {})[key] = path
 
-            upload_file_to_s3(thumb_path, thumb_s3_path)
+    return data
 
-            data['thumbnail'] = thumb_s3_path
+
+def reuse_duplicate(duplicate, s3_path, thumbnail, mode=DEDUP_COPY):
+    """
+    Get the space paths of an image from those of its duplicate, copying
+    the duplicate to `s3_path` in `DEDUP_COPY` mode. None if the
+    duplicate lacks a thumbnail that's needed.
+    """
+    if duplicate is None or (thumbnail and not duplicate['thumbnail']):
+        return None
+
+    if mode == DEDUP_SKIP:
+        data = {'image': duplicate['image']}
+
+        if thumbnail:
+            data['thumbnail'] = duplicate['thumbnail']
 
         return data
+
+    copy_s3_object(duplicate['image'], s3_path)
+
+    data = {'image': s3_path}
+
+    if thumbnail:
+        data['thumbnail'] = s3_path.replace('big', 'thumb')
+        copy_s3_object(duplicate['thumbnail'], data['thumbnail'])
+
+    return data
+
+
+def store_image(
+    data,
+    s3_path,
+    thumbnail=False,
+    index=None,
+    mode=DEDUP_COPY,
+    render=render_renditions,
+    formats=None,
+    target_bytes=None,
+):
+    """
+    Resize and upload downloaded image bytes, unless `index`, an
+    `ImageIndex`, has an exact or near duplicate of them. The index only
+    keeps JPEG paths, so duplicates aren't reused when other `formats`
+    are wanted, those images are uploaded and indexed as usual.
+    """
+    perceptual = index is not None and index.perceptual
+    reuse = index is not None and all(
+        image_format == 'jpeg' for image_format in formats or []
+    )
+
+    if index is not None:
+        digest = content_hash(data)
+
+    if reuse:
+        reused = reuse_duplicate(index.find(digest), s3_path, thumbnail, mode)
+
+        if reused is not None:
+            return reused
+
+    renditions = render(data, thumbnail, perceptual, formats, target_bytes)
+
+    if index is None:
+        return upload_renditions(
+            renditions.big, renditions.thumb, s3_path, renditions.extra,
+        )
+
+    reused = None
+
+    if reuse and renditions.dhash is not None:
+        reused = reuse_duplicate(
+            index.find_similar(renditions.dhash), s3_path, thumbnail, mode,
+        )
+
+    if reused is None:
+        reused = upload_renditions(
+            renditions.big, renditions.thumb, s3_path, renditions.extra,
+        )
+
+    # Near duplicates are indexed too, to be found by hash next time
+    index.add(digest, reused, renditions.dhash)
+
+    return reused
+
+
+def download_upload_image(
+    image_url,
+    s3_path,
+    thumbnail=False,
+    index=None,
+    dedup_mode=DEDUP_COPY,
+    formats=None,
+    target_bytes=None,
+):
+    """
+    Download image and upload it to the space. With `index`, duplicates
+    of already uploaded images are not uploaded again, see `store_image`.
+    Renditions are also uploaded in `formats` besides JPEG, and fit in
+    `target_bytes`, see `render_renditions`.
+    """
+    try:
+        return store_image(
+            download_image(image_url),
+            s3_path,
+            thumbnail,
+            index,
+            dedup_mode,
+            formats=formats,
+            target_bytes=target_bytes,
+        )
     except LowImageQualityException:
         return
+
+
+ImageJob = namedtuple('ImageJob', ['url', 's3_path', 'thumbnail'])
+
+ImageResult = namedtuple('ImageResult', ['job', 'data', 'error'])
+
+
+class ImageEngine:
+    """
+    Download, resize and upload images concurrently.
+
+    Downloads and uploads run in a pool of `workers` threads. Every store
+    host gets its own pooled `requests.Session` and at most
+    `host_concurrency` downloads at a time. Decoding and encoding run in a
+    separate pool of `cpu_workers` threads, or processes with
+    `processes`, as Pillow releases the GIL while working on pixels.
+    """
+
+    def __init__(
+        self,
+        workers=ENGINE_WORKERS,
+        host_concurrency=ENGINE_HOST_CONCURRENCY,
+        cpu_workers=None,
+        processes=False,
+        index=None,
+        dedup_mode=DEDUP_COPY,
+        formats=None,
+        target_bytes=None,
+    ):
+        """
+        Variable initialization. With `index`, an `ImageIndex`, duplicate
+        images are handled as `dedup_mode` says. `formats` and
+        `target_bytes` are passed on to `render_renditions`
+        """
+        self.workers = workers
+        self.host_concurrency = host_concurrency
+        self.index = index
+        self.dedup_mode = dedup_mode
+        self.formats = formats
+        self.target_bytes = target_bytes
+
+        self.io_pool = ThreadPoolExecutor(workers)
+
+        if processes:
+            self.cpu_pool = ProcessPoolExecutor(cpu_workers)
+        else:
+            self.cpu_pool = ThreadPoolExecutor(cpu_workers or os.cpu_count())
+
+        self.sessions = {}
+        self.semaphores = {}
+        self.hosts_lock = threading.Lock()
+
+    def __enter__(self):
+        """Use the engine as a context manager."""
+        return self
+
+    def __exit__(self, *args):
+        """Shut down pools on exit."""
+        self.close()
+
+    def close(self):
+        """Shut down pools and close sessions."""
+        self.io_pool.shutdown()
+        self.cpu_pool.shutdown()
+
+        for session in self.sessions.values():
+            session.close()
+
+    def get_host(self, host):
+        """Get the session and semaphore of a host."""
+        with self.hosts_lock:
+            if host not in self.sessions:
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.host_concurrency,
+                )
+
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+
+                self.sessions[host] = session
+                self.semaphores[host] = threading.BoundedSemaphore(
+                    self.host_concurrency,
+                )
+
+            return self.sessions[host], self.semaphores[host]
+
+    def process(self, job):
+        """Download, resize and upload an image, None if it's too small."""
+        session, semaphore = self.get_host(
+            urllib.parse.urlsplit(job.url).netloc,
+        )
+
+        try:
+            with semaphore:
+                data = download_image(job.url, session)
+
+            return store_image(
+                data,
+                job.s3_path,
+                job.thumbnail,
+                self.index,
+                self.dedup_mode,
+                self.render,
+                self.formats,
+                self.target_bytes,
+            )
+        except LowImageQualityException:
+            return None
+
+    def render(self, *args):
+        """Render renditions in the CPU pool."""
+        return self.cpu_pool.submit(render_renditions, *args).result()
+
+    def run(self, jobs):
+        """
+        Process `(url, s3_path, thumbnail)` jobs, yielding an `ImageResult`
+        for each as soon as it's done. `data` is what
+        `download_upload_image` returns, and `error` the exception raised
+        while processing the job, if any. At most two jobs per worker are
+        queued at a time, so jobs can be a lazy iterable.
+        """
+        jobs = iter(jobs)
+        pending = {}
+
+        while True:
+            for job in jobs:
+                job = ImageJob(*job)
+                pending[self.io_pool.submit(self.process, job)] = job
+
+                if len(pending) >= self.workers * 2:
+                    break
+
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                job = pending.pop(future)
+                error = future.exception()
+
+                if error is None:
+                    yield ImageResult(job, future.result(), None)
+                else:
+                    yield ImageResult(job, None, error)
@@ -0,0 +1,207 @@
+"""Multi keyword matching utils."""
+from collections import deque
+
+
+# Below this many keywords an ordered scan of C level substring checks
+# is faster than walking the automaton character by character in Python
+AUTOMATON_MIN_KEYWORDS = 128
+
+# Lookups served by the ordered scan before building the automaton, which
+# costs about as much as this many scans
+AUTOMATON_MIN_LOOKUPS = 128
+
+# Keywords added after the last build that are checked one by one before
+# the automaton gets rebuilt with them
+MAX_PENDING_KEYWORDS = 64
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton over a list of keywords.
+
+    `find` scans a text once and returns the first keyword, in the order
+    they were given, that appears anywhere in the text. It is equivalent
+    to `next(k for k in keywords if k in text)` but, past
+    `AUTOMATON_MIN_KEYWORDS`, its cost does not grow with the number of
+    keywords. The automaton is only built after `AUTOMATON_MIN_LOOKUPS`
+    lookups, so rarely used matchers never pay for it.
+
+    With `longest_first` the longest keyword wins instead, ties going to
+    the one given first, like scanning keywords sorted with
+    `sorted(keywords, key=len, reverse=True)`.
+
+    Keywords can be added later on with `add`. They are checked one by
+    one until there are more than `MAX_PENDING_KEYWORDS` of them, and
+    then compiled into the automaton.
+    """
+
+    def __init__(
+        self,
+        keywords=(),
+        longest_first=False,
+        min_keywords=AUTOMATON_MIN_KEYWORDS,
+        min_lookups=AUTOMATON_MIN_LOOKUPS,
+        max_pending=MAX_PENDING_KEYWORDS,
+    ):
+        """Initialize variables."""
+        self.longest_first = longest_first
+        self.min_keywords = min_keywords
+        self.min_lookups = min_lookups
+        self.max_pending = max_pending
+
+        self._lookups = 0
+
+        self._order = {
+            keyword: order
+            for order, keyword in enumerate(dict.fromkeys(keywords))
+        }
+
+        self._rebuild()
+
+    def __len__(self):
+        """Get the number of keywords."""
+        return len(self._order)
+
+    def __contains__(self, keyword):
+        """Check if a keyword was added."""
+        return keyword in self._order
+
+    def _priority(self, keyword):
+        """Get the sort key of a keyword, lower wins."""
+        if self.longest_first:
+            return -len(keyword), self._order[keyword]
+
+        return self._order[keyword]
+
+    def add(self, keyword):
+        """Add a keyword, with the lowest priority among equals."""
+        if keyword in self._order:
+            return
+
+        self._order[keyword] = len(self._order)
+        self._pending.append(keyword)
+
+        if len(self._pending) > self.max_pending:
+            self._rebuild()
+
+    def _rebuild(self):
+        """Compile every keyword, in priority order."""
+        # Keywords are kept in insertion order, so a stable sort by length
+        # is the same as sorting by priority
+        if self.longest_first:
+            self.keywords = sorted(self._order, key=len, reverse=True)
+        else:
+            self.keywords = list(self._order)
+
+        self._pending = []
+        self._goto = None
+
+        if self._should_build():
+            self._build()
+
+    def _should_build(self):
+        """Check if the automaton is worth building."""
+        return len(self.keywords) >= self.min_keywords and \
+            self._lookups >= self.min_lookups
+
+    def _build(self):
+        """Build goto, failure and output tables."""
+        no_match = len(self.keywords)
+
+        goto = [{}]
+        out = [no_match]
+
+        # Trie of keywords, each final state keeps its keyword rank
+        for rank, keyword in enumerate(self.keywords):
+            state = 0
+
+            for char in keyword:
+                next_state = goto[state].get(char)
+
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    out.append(no_match)
+
+                state = next_state
+
+            out[state] = min(out[state], rank)
+
+        # Failure links, in breadth first order so that each state can
+        # inherit the best rank of its longest proper suffix
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+
+        for state in queue:
+            out[state] = min(out[state], out[0])
+
+        while queue:
+            state = queue.popleft()
+
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+
+                fallback = fail[state]
+
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+
+                fail[next_state] = goto[fallback].get(char, 0)
+                out[next_state] = min(out[next_state], out[fail[next_state]])
+
+        self._goto = goto
+        self._fail = fail
+        self._out = out
+        self._no_match = no_match
+
+    def _find_compiled(self, text):
+        """Find the first compiled keyword present in text."""
+        if self._goto is None:
+            self._lookups += 1
+
+            if self._should_build():
+                self._build()
+
+        if self._goto is None:
+            for keyword in self.keywords:
+                if keyword in text:
+                    return keyword
+
+            return None
+
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+
+        state = 0
+        best = out[0]
+
+        for char in text:
+            if best == 0:
+                break
+
+            while state and char not in goto[state]:
+                state = fail[state]
+
+            state = goto[state].get(char, 0)
+
+            if out[state] < best:
+                best = out[state]
+
+        if best < self._no_match:
+            return self.keywords[best]
+
+        return None
+
+    def find(self, text):
+        """Return the first keyword present in text, or None."""
+        best = self._find_compiled(text)
+
+        for keyword in self._pending:
+            if keyword in text:
+                if best is None or \
+                        self._priority(keyword) < self._priority(best):
+                    best = keyword
+
+        return best
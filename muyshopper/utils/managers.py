@@ -1,9 +1,10 @@
 """Image utils."""
 from muyshopper.utils.slug import create_product_slug
-from muyshopper.utils.images import download_upload_image
+from muyshopper.utils.images import ImageJob, download_upload_image
 from muyshopper.utils.space import (
     get_product_images_in_space_online,
     get_product_images_in_space,
+    space_inventory,
     store_images_in_space,
     has_thumbnail,
     create_s3_path,
@@ -20,6 +21,78 @@ class ImageManager:
         """Initialize variables."""
         pass
 
+    def plan_images(self, items):
+        """
+        Plan the images to download for a whole crawl, as `ImageJob`s.
+
+        Items are grouped by product slug and looked up in the space
+        inventory. As with `manage_product_images`, a product gets the
+        first images of stores it has none from, up to
+        `IMAGES_PER_PRODUCT` counting those in the space and those
+        planned for other stores, and a thumbnail from its first image
+        if it has none. Images with a query string or a long extension
+        are skipped, and each URL is planned once per product.
+        """
+        products = {}
+
+        for item in items:
+            if not item.get('marca') or not item.get('modelo'):
+                continue
+
+            if not item.get('image_urls'):
+                continue
+
+            products.setdefault(create_product_slug(item), []).append(item)
+
+        jobs = []
+
+        for slug, slug_items in products.items():
+            planned_stores = set()
+            planned_urls = set()
+
+            count = len(space_inventory.images_for(slug))
+            need_thumbnail = not space_inventory.has_thumbnail(slug)
+
+            for item in slug_items:
+                store = item['empresa'].lower()
+
+                if count >= IMAGES_PER_PRODUCT:
+                    continue
+
+                if store in planned_stores or space_inventory.has_store(
+                    slug, store,
+                ):
+                    continue
+
+                planned_stores.add(store)
+                store_count = 1
+
+                image_links = item['image_urls'][:IMAGES_PER_PRODUCT - count]
+
+                for image_url in image_links:
+                    # If image_url is invalid, skip image_url
+                    if '?' in image_url or image_url in planned_urls:
+                        continue
+
+                    # If extension is invalid, skip image_url
+                    extension = image_url.split('.')[-1]
+
+                    if len(extension) > 3:
+                        continue
+
+                    jobs.append(ImageJob(
+                        image_url,
+                        create_s3_path(slug, store, store_count, extension),
+                        need_thumbnail,
+                    ))
+
+                    planned_urls.add(image_url)
+                    need_thumbnail = False
+                    store_count += 1
+                    count += 1
+
+        return jobs
+
     def manage_product_images_online(self, item):
         """Manage product images online."""
         # Create product slug
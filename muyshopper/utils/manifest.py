@@ -0,0 +1,350 @@
+"""Space manifest utils."""
+import os
+import mmap
+import fcntl
+import time
+import threading
+
+from collections import namedtuple
+
+
+MANIFEST_VERSION = '1'
+
+# Seconds between full listings, incremental refreshes miss deletions
+# and keys sorted before the last known one, unless journaled
+FULL_SYNC_INTERVAL = 24 * 60 * 60
+
+Entry = namedtuple('Entry', ['key', 'size', 'etag', 'last_modified'])
+
+Header = namedtuple('Header', ['version', 'full_sync', 'sync', 'count'])
+
+
+def format_entry(entry):
+    """Get the manifest line of an entry, unknown fields are empty."""
+    return '{}\t{}\t{}\t{}\n'.format(
+        entry.key,
+        '' if entry.size is None else entry.size,
+        entry.etag or '',
+        '' if entry.last_modified is None else entry.last_modified,
+    )
+
+
+def parse_entry(line):
+    """Get the entry of a manifest line."""
+    key, size, etag, last_modified = line.rstrip('\n').split('\t')
+
+    return Entry(
+        key,
+        int(size) if size else None,
+        etag or None,
+        int(last_modified) if last_modified else None,
+    )
+
+
+def merge_entries(entries, changes):
+    """
+    Merge `key -> entry` changes into entries sorted by key. A None
+    change removes the key.
+    """
+    changes = sorted(changes.items())
+    index = 0
+
+    for entry in entries:
+        while index < len(changes) and changes[index][0] <= entry.key:
+            key, change = changes[index]
+            index += 1
+
+            if change is not None:
+                yield change
+
+            if key == entry.key:
+                break
+        else:
+            yield entry
+
+    for key, change in changes[index:]:
+        if change is not None:
+            yield change
+
+
+class Manifest:
+    """
+    Sorted listing of space keys, with their size, ETag and last
+    modified time, stored as a tab separated file.
+
+    The file is memory mapped and lines are sorted by key, so a key or
+    a prefix is found by binary search without reading the whole file.
+    Uploads and deletions are appended to a journal and merged by
+    `refresh`, which also lists the keys sorted after the last known
+    one of each prefix. A full listing is done when the manifest is
+    missing or its last one is older than `full_sync_interval`.
+    """
+
+    def __init__(self, path, full_sync_interval=FULL_SYNC_INTERVAL):
+        """Variable initialization."""
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.lock_path = path + '.lock'
+        self.full_sync_interval = full_sync_interval
+
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self._map = None
+        self._stat = None
+        self._header = None
+        self._start = 0
+
+    def open(self):
+        """Map the manifest file, again if it was replaced, None if none."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+
+        stat = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        with self.lock:
+            if self._stat != stat:
+                with open(self.path, 'rb') as fp:
+                    self._map = mmap.mmap(
+                        fp.fileno(), 0, access=mmap.ACCESS_READ,
+                    )
+
+                end = self._map.find(b'\n') + 1
+                fields = self._map[:end].decode().rstrip('\n').split('\t')
+
+                self._header = Header(
+                    fields[1], int(fields[2]), int(fields[3]), int(fields[4]),
+                )
+                self._start = end
+                self._stat = stat
+
+            return self._map
+
+    def header(self):
+        """Get the header of the manifest, None if there is none."""
+        if self.open() is None:
+            return None
+
+        return self._header
+
+    def age(self):
+        """Get seconds since the last refresh, None if never refreshed."""
+        header = self.header()
+
+        if header is None:
+            return None
+
+        return time.time() - header.sync
+
+    def __len__(self):
+        """Get the number of keys."""
+        header = self.header()
+
+        return header.count if header else 0
+
+    def lower_bound(self, key):
+        """Get the offset of the first line with a key not below `key`."""
+        data = self.open()
+        key = key.encode()
+
+        low, high = self._start, len(data)
+
+        while low < high:
+            middle = (low + high) // 2
+
+            newline = data.rfind(b'\n', low, middle)
+            line = newline + 1 if newline >= 0 else low
+            end = data.find(b'\n', line)
+
+            if data[line:data.find(b'\t', line, end)] < key:
+                low = end + 1
+            else:
+                high = line
+
+        return low
+
+    def iter_entries(self, prefix=''):
+        """Lazily get the entries of keys starting with `prefix`."""
+        data = self.open()
+
+        if data is None:
+            return
+
+        offset = self.lower_bound(prefix) if prefix else self._start
+        prefix = prefix.encode()
+
+        while offset < len(data):
+            end = data.find(b'\n', offset)
+            line = data[offset:end]
+
+            if not line.startswith(prefix):
+                return
+
+            yield parse_entry(line.decode())
+            offset = end + 1
+
+    def keys(self, prefix=''):
+        """Lazily get the keys starting with `prefix`."""
+        for entry in self.iter_entries(prefix):
+            yield entry.key
+
+    def get(self, key):
+        """Get the entry of a key, None if not in the manifest."""
+        entry = next(self.iter_entries(key), None)
+
+        if entry is None or entry.key != key:
+            return None
+
+        return entry
+
+    def __contains__(self, key):
+        """Check for a key."""
+        return self.get(key) is not None
+
+    def last_key(self, prefix):
+        """Get the last key starting with `prefix`, None if none."""
+        data = self.open()
+
+        if data is None or not prefix:
+            return None
+
+        # First string sorted after every key starting with prefix
+        offset = self.lower_bound(prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+        if offset <= self._start:
+            return None
+
+        newline = data.rfind(b'\n', self._start, offset - 1)
+        line = newline + 1 if newline >= 0 else self._start
+        key = parse_entry(data[line:offset - 1].decode()).key
+
+        return key if key.startswith(prefix) else None
+
+    def record(self, key, size=None, etag=None, last_modified=None):
+        """Journal an uploaded key."""
+        if last_modified is None:
+            last_modified = int(time.time())
+
+        self.write_journal(
+            '+\t' + format_entry(Entry(key, size, etag, last_modified)),
+        )
+
+    def record_delete(self, key):
+        """Journal a deleted key."""
+        self.write_journal('-\t' + format_entry(Entry(key, None, None, None)))
+
+    def write_journal(self, line):
+        """
+        Append a line to the journal, in a single write under an
+        exclusive lock, to the journal file that is current once locked.
+        """
+        while True:
+            with open(self.journal_path, 'a') as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+
+                try:
+                    current = os.stat(self.journal_path).st_ino
+                except FileNotFoundError:
+                    current = None
+
+                # Otherwise taken since opened, so write to a new one
+                if current == os.fstat(fp.fileno()).st_ino:
+                    fp.write(line)
+                    return
+
+    def take_journal(self):
+        """Read and clear the journal as `key -> entry or None` changes."""
+        taken_path = '{}.{}.{}'.format(
+            self.journal_path, os.getpid(), threading.get_ident(),
+        )
+
+        try:
+            os.replace(self.journal_path, taken_path)
+        except FileNotFoundError:
+            return {}
+
+        changes = {}
+
+        with open(taken_path, 'r') as fp:
+            # Waits for writes to the journal before it was taken
+            fcntl.flock(fp, fcntl.LOCK_EX)
+
+            for line in fp:
+                operation, line = line.split('\t', 1)
+                entry = parse_entry(line)
+                changes[entry.key] = entry if operation == '+' else None
+
+        os.remove(taken_path)
+
+        return changes
+
+    def write(self, entries, full_sync, sync):
+        """Atomically replace the manifest with entries sorted by key."""
+        tmp_path = '{}.{}.{}.tmp'.format(
+            self.path, os.getpid(), threading.get_ident(),
+        )
+        header = '#manifest\t{}\t{}\t{}\t{:020d}\n'
+        count = 0
+
+        with open(tmp_path, 'w') as fp:
+            fp.write(header.format(MANIFEST_VERSION, full_sync, sync, 0))
+
+            for entry in entries:
+                fp.write(format_entry(entry))
+                count += 1
+
+            # The count is padded, so it's rewritten in place
+            fp.seek(0)
+            fp.write(header.format(MANIFEST_VERSION, full_sync, sync, count))
+
+        os.replace(tmp_path, self.path)
+
+        return count
+
+    def refresh(self, list_objects, prefixes, full=False):
+        """
+        Update the manifest. `list_objects(prefix, start_after)` lazily
+        gets the entries of a prefix sorted by key, after `start_after`
+        when given. Returns whether a full listing was done. Refreshes
+        run one at a time, across threads and processes.
+        """
+        with self.refresh_lock, open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            header = self.header()
+            now = int(time.time())
+
+            full = (
+                full or
+                header is None or
+                now - header.full_sync >= self.full_sync_interval
+            )
+
+            # Keys uploaded while listing stay journaled for the next refresh
+            changes = self.take_journal()
+
+            if full:
+                entries = sorted(
+                    (
+                        entry
+                        for prefix in prefixes
+                        for entry in list_objects(prefix, None)
+                    ),
+                    key=lambda entry: entry.key,
+                )
+                self.write(entries, now, now)
+
+                return True
+
+            for prefix in prefixes:
+                for entry in list_objects(prefix, self.last_key(prefix)):
+                    changes[entry.key] = entry
+
+            self.write(
+                merge_entries(self.iter_entries(), changes),
+                header.full_sync,
+                now,
+            )
+
+            return False
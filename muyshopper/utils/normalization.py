@@ -1,70 +1,229 @@
 """Normalization utils."""
 import re
-from unidecode import unidecode
+from itertools import islice
+
+from muyshopper.utils.keywords import KeywordMatcher
+from muyshopper.utils.text import canonical
+
+
+# Compiled keyword matchers by mapping id
+_keyword_matchers = {}
+
+# Numeric patterns
+INTEGER_RE = re.compile(r"\d+")
+FLOAT_RE = re.compile(r"[-+]?\d*\.\d+|\d+")
+
+# Unit aliases by base unit, with the factor to convert them to it
+UNITS = {
+    'pulgadas': {
+        'pulgadas': 1, 'pulgada': 1, 'pulg': 1, 'plg': 1,
+        'inches': 1, 'inch': 1, 'in': 1, '"': 1, "''": 1,
+        'cm': 1 / 2.54,
+    },
+    'kg': {
+        'kilogramos': 1, 'kilos': 1, 'kilo': 1, 'kgs': 1, 'kg': 1,
+        'gramos': 0.001, 'grs': 0.001, 'gr': 0.001, 'g': 0.001,
+    },
+    'gb': {
+        'tb': 1024, 'gb': 1, 'mb': 1 / 1024,
+    },
+    'w': {
+        'kw': 1000, 'watts': 1, 'watt': 1, 'w': 1,
+    },
+    'frigorias': {
+        'frigorias': 1, 'frigoria': 1, 'frig': 1, 'fg': 1,
+    },
+    'mah': {
+        'mah': 1,
+    },
+}
+
+# Any unit alias, longest first
+UNIT_PATTERN = '|'.join(
+    re.escape(alias) for alias in sorted(
+        {alias for aliases in UNITS.values() for alias in aliases},
+        key=len,
+        reverse=True,
+    )
+)
+
+# A number, with Argentine "1.234,56" or plain "1234.56" separators,
+# optionally followed by one of the known unit aliases. Dots are
+# thousands separators when there are several groups ("1.234.567") or
+# a decimal comma ("1.234,5"), never after a leading zero ("0.750").
+# A single group ("12.999") is ambiguous, see `parse_quantity_number`
+QUANTITY_RE = re.compile(
+    r"(?:(?P<grouped>[1-9]\d{0,2}"
+    r"(?:(?:\.\d{3}){2,}(?!\d)(?:,\d+)?|\.\d{3},\d+))"
+    r"|(?P<single>[1-9]\d{0,2}\.\d{3})(?![\d,])"
+    r"|(?P<plain>\d+(?:[.,]\d+)?))"
+    r"(?:\s*(?P<unit>" + UNIT_PATTERN + r")(?![a-z]))?"
+)
+
+# Significant digits kept when converting between units
+MEASURE_DIGITS = 10
+
+# Units only written in whole numbers, "3.000 frigorias" and "1.500 W"
+# are 3000 and 1500
+INTEGER_UNITS = {'frigorias', 'mah', 'w'}
 
 
 def parse_contains_boolean(input_value, keyword):
     """Check if value is in string and returns a boolean."""
-    input_value = unidecode(input_value.lower())
-    return keyword in input_value
+    return keyword in canonical(input_value)
+
+
+def get_keyword_matcher(mapping):
+    """
+    Get the compiled keyword matcher of a mapping, building it the first
+    time the mapping is used. Mappings are not expected to change after
+    that.
+    """
+    cached = _keyword_matchers.get(id(mapping))
+
+    if cached is None or cached[0] is not mapping:
+        cached = (mapping, KeywordMatcher(mapping.keys()))
+        _keyword_matchers[id(mapping)] = cached
+
+    return cached[1]
 
 
 def parse_contains_string(input_value, mapping):
     """Check if value is in string and returns normalized value."""
-    for key in mapping.keys():
-        if key in unidecode(input_value.lower()):
-            return mapping[key]
+    key = get_keyword_matcher(mapping).find(canonical(input_value))
+
+    if key is not None:
+        return mapping[key]
 
 
 def find_integer_in_string(value, count=1, limit=None):
     """Find an integer in a string."""
     if value:
-        value = str(value).lower()
+        value = str(value)
 
-        try:
-            numbers = re.findall(r"\d+", value)[:count]
+        if count > 1:
+            return [
+                int(match.group())
+                for match in islice(INTEGER_RE.finditer(value), count)
+            ]
 
-            numbers = [int(number) for number in numbers]
+        match = INTEGER_RE.search(value)
 
-            if count > 1:
-                if type(numbers) is int:
-                    return None
-                else:
-                    return numbers
-            else:
-                return numbers[0]
-        except IndexError:
-            return None
+        if match:
+            return int(match.group())
 
 
 def find_float_in_string(value, limit=None, keep_right_zeros=True):
     """Find float number in a string."""
     if value:
-        value = str(value).lower()
+        value = str(value).replace(',', '.')
 
-        try:
-            value = value.replace(',', '.')
-            number = re.findall(r"[-+]?\d*\.\d+|\d+", value)[0]
-            # number = re.findall(r"\d+\.\d+", value)[0] # ONLY FLOAT, NO INT
+        match = FLOAT_RE.search(value)
 
-            number = float(number)
+        if match:
+            number = float(match.group())
 
             if not keep_right_zeros:
-                if float(number) % 1 == 0:
+                if number % 1 == 0:
                     number = int(number)
 
             if limit and number > limit:
                 return None
 
             return number
-        except IndexError:
-            return None
+
+
+def parse_quantity(grouped, single, plain, unit, thousands=None):
+    """
+    Parse the number groups of a `QUANTITY_RE` match. A single dot
+    group is read as thousands ("$ 12.999") unless a unit follows
+    ("27.668in"), `thousands` forces either reading.
+    """
+    if grouped:
+        return float(grouped.replace('.', '').replace(',', '.'))
+
+    if single:
+        if thousands is None:
+            thousands = unit is None
+
+        return float(single.replace('.', '') if thousands else single)
+
+    return float(plain.replace(',', '.'))
+
+
+def parse_quantity_number(match, thousands=None):
+    """Parse the number of a `QUANTITY_RE` match."""
+    return parse_quantity(*match.group(
+        'grouped', 'single', 'plain', 'unit',
+    ), thousands=thousands)
+
+
+def find_number_in_string(value, limit=None, keep_right_zeros=True):
+    """Find a number in a string, understanding "1.234,56" formatting."""
+    if value:
+        match = QUANTITY_RE.search(str(value))
+
+        if match:
+            number = parse_quantity_number(match)
+
+            if not keep_right_zeros:
+                if number % 1 == 0:
+                    number = int(number)
+
+            if limit and number > limit:
+                return None
+
+            return number
+
+
+def convert_measure(number, factor):
+    """
+    Convert a number with a unit factor, rounded to `MEASURE_DIGITS`
+    significant digits so that small values ("4 g" in kg) don't round
+    to zero.
+    """
+    if factor == 1:
+        return number
+
+    return float('{:.{}g}'.format(number * factor, MEASURE_DIGITS))
+
+
+def find_measure_in_string(value, unit):
+    """
+    Find a measure in a string and convert it to `unit`. The first
+    number written in any alias of `unit` wins, falling back to the
+    first number written without a unit
+    """
+    if value:
+        aliases = UNITS[unit]
+        thousands = True if unit in INTEGER_UNITS else None
+        fallback = None
+
+        for match in QUANTITY_RE.finditer(canonical(str(value))):
+            alias = match.group('unit')
+
+            if alias in aliases:
+                number = parse_quantity_number(match, thousands)
+                return convert_measure(number, aliases[alias])
+
+            if alias is None and fallback is None:
+                fallback = parse_quantity_number(match, thousands)
+
+        return fallback
+
+
+def find_integer_measure_in_string(value, unit):
+    """Find a measure in a string, converted to `unit` and rounded."""
+    number = find_measure_in_string(value, unit)
+
+    if number is not None:
+        return int(round(number))
 
 
 def find_boolean_in_string(value, limit=None):
     """Find boolean in a string."""
     if value:
-        value = unidecode(str(value).lower())
+        value = canonical(str(value))
 
         positive_values = ['si', 'true']
         negative_values = ['no', 'false']
@@ -111,6 +270,70 @@ def normalize_field_value(field_name, field_value):
         return None
 
 
+def _bind_arguments(func, args):
+    """Bind extra arguments after the value argument of `func`."""
+    if not args:
+        return func
+
+    if len(args) == 1:
+        arg = args[0]
+
+        def bound(value):
+            return func(value, arg)
+    else:
+        def bound(value):
+            return func(value, *args)
+
+    return bound
+
+
+def compile_normalization_plan(mapping):
+    """
+    Compile a field mapping into a `field -> callable` plan, binding
+    the extra arguments once and leaving out fields with no function
+    """
+    plan = {}
+
+    for field_name, (func, args) in mapping.items():
+        if not func:
+            continue
+
+        plan[field_name] = _bind_arguments(func, args)
+
+    return plan
+
+
+def normalize_item(item, plan=None):
+    """
+    Normalize every field of an attributes dict, returning the same
+    values `normalize_field_value` would return field by field
+    """
+    if plan is None:
+        plan = NORMALIZATION_PLAN
+
+    get_func = plan.get
+    normalized = {}
+
+    for field_name, field_value in item.items():
+        func = get_func(field_name)
+
+        if func is not None and field_value:
+            normalized[field_name] = func(field_value)
+        else:
+            normalized[field_name] = None
+
+    return normalized
+
+
+def normalize_items(items, plan=None):
+    """Lazily normalize an iterable of attributes dicts."""
+    if plan is None:
+        plan = NORMALIZATION_PLAN
+
+    for item in items:
+        yield normalize_item(item, plan)
+
+
 field_to_normalize_function = {
     'tipo_disco': (
         parse_contains_string, [
@@ -139,7 +362,7 @@ field_to_normalize_function = {
             }
         ]
     ),
-    'peso': (find_float_in_string, []),
+    'peso': (find_measure_in_string, ['kg']),
     'enfriamiento': (
       parse_contains_string, [
             {
@@ -323,7 +546,7 @@ field_to_normalize_function = {
             }
         ]
     ),
-    'pantalla': (find_float_in_string, []),
+    'pantalla': (find_measure_in_string, ['pulgadas']),
     'valvula_de_seguridad': (None, None),
     'sistema_operativo': (
         parse_contains_string, [
@@ -340,7 +563,7 @@ field_to_normalize_function = {
         ]
     ),
     'camara_trasera': (find_float_in_string, []),
-    'memoria_ram': (find_float_in_string, []),
+    'memoria_ram': (find_measure_in_string, ['gb']),
     'tipo_equipo': (
         parse_contains_string, [
             {
@@ -367,8 +590,8 @@ field_to_normalize_function = {
     'alto': (find_float_in_string, []),
     'pantalla_touch': (find_boolean_in_string, []),
     'profundo': (find_float_in_string, []),
-    'bateria': (find_integer_in_string, []),
-    'potencia': (find_integer_in_string, []),
+    'bateria': (find_integer_measure_in_string, ['mah']),
+    'potencia': (find_integer_measure_in_string, ['w']),
     'procesador': (None, None),
     'tresd': (find_boolean_in_string, []),
     'conexion': (
@@ -383,7 +606,7 @@ field_to_normalize_function = {
         ]
     ),
     'placa_grafica': (None, None),
-    'frigorias': (find_integer_in_string, []),
+    'frigorias': (find_integer_measure_in_string, ['frigorias']),
     'operador': (
         parse_contains_string, [
             {
@@ -417,3 +640,8 @@ field_to_normalize_function = {
         ]
     ),
 }
+
+
+# Precompiled plan for `field_to_normalize_function`. Rebuild it with
+# `compile_normalization_plan` if the mapping is changed at runtime.
+NORMALIZATION_PLAN = compile_normalization_plan(field_to_normalize_function)
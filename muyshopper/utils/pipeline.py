@@ -0,0 +1,362 @@
+"""Item pipeline utils."""
+import json
+import time
+import multiprocessing
+
+from collections import deque
+from itertools import islice
+
+from muyshopper.utils.normalization import normalize_item
+from muyshopper.utils.postprocess import PostProcess
+from muyshopper.utils.slug import create_product_slug
+from muyshopper.utils.tracking import STORE_URL_MAP, get_tracker_link
+
+
+# Items sent at once to a worker process
+PIPELINE_CHUNK_SIZE = 500
+
+# Chunks waiting for results per worker, bounds memory with workers
+MAX_PENDING_CHUNKS = 2
+
+# Items pushed to redis per round trip
+REDIS_BATCH_SIZE = 500
+
+# Pipeline run by forked workers
+_pipeline = None
+
+
+def _process_chunk(chunk):
+    """Run the shared pipeline stages over a chunk of items."""
+    _pipeline.reset_stats()
+
+    for stage in _pipeline.stages:
+        stage.reset_state()
+
+    results = [_pipeline.process_item(item) for item in chunk]
+
+    return results, [
+        (stage.counters(), stage.state()) for stage in _pipeline.stages
+    ]
+
+
+def chunked(items, size):
+    """Lazily split an iterable into lists of `size` items."""
+    items = iter(items)
+    chunk = list(islice(items, size))
+
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, size))
+
+
+class Stage:
+    """
+    Pipeline step calling `func` with an item, which returns the item
+    to pass on or None to drop it. Calls, passed items and time are
+    counted.
+    """
+
+    def __init__(self, func, name=None):
+        """Initialize variables."""
+        self.func = func
+        self.name = name or getattr(func, '__name__', type(func).__name__)
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Reset counters."""
+        self.calls = 0
+        self.passed = 0
+        self.seconds = 0
+        self.max_seconds = 0
+
+    def __call__(self, item):
+        """Run the stage over an item."""
+        start = time.perf_counter()
+        item = self.func(item)
+        elapsed = time.perf_counter() - start
+
+        self.calls += 1
+        self.seconds += elapsed
+
+        if elapsed > self.max_seconds:
+            self.max_seconds = elapsed
+
+        if item is not None:
+            self.passed += 1
+
+        return item
+
+    def counters(self):
+        """Get raw counters, to merge them into another stage."""
+        return self.calls, self.passed, self.seconds, self.max_seconds
+
+    def merge(self, counters):
+        """Add counters of the same stage run elsewhere."""
+        calls, passed, seconds, max_seconds = counters
+
+        self.calls += calls
+        self.passed += passed
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, max_seconds)
+
+    def reset_state(self):
+        """Forget state changes to send back, before a worker chunk."""
+        pass
+
+    def state(self):
+        """Get state changes of a worker chunk, to merge them back."""
+        return None
+
+    def merge_state(self, state):
+        """Apply state changes of the same stage run in a worker."""
+        pass
+
+    def stats(self):
+        """Get throughput and latency stats."""
+        return {
+            'name': self.name,
+            'items': self.calls,
+            'passed': self.passed,
+            'dropped': self.calls - self.passed,
+            'seconds': self.seconds,
+            'items_per_second':
+                self.calls / self.seconds if self.seconds else 0,
+            'mean_latency': self.seconds / self.calls if self.calls else 0,
+            'max_latency': self.max_seconds,
+        }
+
+
+class MatchStage(Stage):
+    """
+    Stage matching items with a `ProductMatcher`. Brands & models
+    learned in workers are learned back by the parent matcher, so that
+    `save` persists them.
+    """
+
+    def __init__(self, matcher, name='match_product'):
+        """Initialize variables."""
+        super().__init__(matcher.match_product, name)
+        self.matcher = matcher
+
+    def reset_state(self):
+        """Forget the brands & models learned so far."""
+        self.matcher.marcas_learned = []
+        self.matcher.modelos_learned = []
+
+    def state(self):
+        """Get the brands & models learned."""
+        return self.matcher.marcas_learned, self.matcher.modelos_learned
+
+    def merge_state(self, state):
+        """Learn brands & models learned in a worker."""
+        marcas, modelos = state
+
+        for marca in marcas:
+            self.matcher.learn_marca(marca)
+
+        for marca, modelo in modelos:
+            self.matcher.learn_modelo(marca, modelo)
+
+
+class Pipeline:
+    """
+    Chain of stages run lazily over an iterable of items.
+
+    `run` is a generator, items are read, processed and yielded one at a
+    time, so memory doesn't grow with the number of items. An item is
+    dropped as soon as a stage returns None.
+
+    With `workers`, chunks of `chunk_size` items are processed in forked
+    processes, at most `MAX_PENDING_CHUNKS` per worker at a time, and
+    yielded in input order. Counters and the state changes a stage
+    reports, such as the brands & models learned by a `MatchStage`, are
+    merged back in chunk order; any other state changed in workers
+    stays there.
+    """
+
+    def __init__(self, stages, workers=None, chunk_size=PIPELINE_CHUNK_SIZE):
+        """Wrap functions as stages and initialize variables."""
+        self.stages = [
+            stage if isinstance(stage, Stage) else Stage(stage)
+            for stage in stages
+        ]
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+    def process_item(self, item):
+        """Run all stages over an item, None if a stage dropped it."""
+        for stage in self.stages:
+            item = stage(item)
+
+            if item is None:
+                return None
+
+        return item
+
+    def run(self, items):
+        """Lazily process items, yielding the ones not dropped."""
+        if self.workers and self.workers > 1:
+            yield from self.run_parallel(items)
+            return
+
+        for item in items:
+            item = self.process_item(item)
+
+            if item is not None:
+                yield item
+
+    def run_parallel(self, items):
+        """Process chunks of items in worker processes."""
+        global _pipeline
+
+        context = multiprocessing.get_context('fork')
+
+        _pipeline = self
+
+        try:
+            pool = context.Pool(self.workers)
+        finally:
+            _pipeline = None
+
+        with pool:
+            pending = deque()
+
+            for chunk in chunked(items, self.chunk_size):
+                pending.append(pool.apply_async(_process_chunk, (chunk,)))
+
+                if len(pending) >= self.workers * MAX_PENDING_CHUNKS:
+                    yield from self.collect(pending.popleft().get())
+
+            while pending:
+                yield from self.collect(pending.popleft().get())
+
+    def collect(self, chunk_result):
+        """Merge worker counters & state, yield the items not dropped."""
+        results, stages = chunk_result
+
+        for stage, (counters, state) in zip(self.stages, stages):
+            stage.merge(counters)
+
+            if state is not None:
+                stage.merge_state(state)
+
+        for item in results:
+            if item is not None:
+                yield item
+
+    def reset_stats(self):
+        """Reset counters of every stage."""
+        for stage in self.stages:
+            stage.reset_stats()
+
+    def stats(self):
+        """Get throughput and latency stats of every stage, in order."""
+        return [stage.stats() for stage in self.stages]
+
+
+def postprocess_stage(postprocess=None):
+    """Stage normalizing prices, dropping items without one."""
+    return Stage((postprocess or PostProcess()).process_item, 'postprocess')
+
+
+def match_stage(matcher):
+    """Stage matching items with a `ProductMatcher`."""
+    return MatchStage(matcher)
+
+
+def normalize_stage(
+    field='attributes',
+    plan=None,
+    target='normalized_attributes',
+):
+    """
+    Stage normalizing the attributes dict in `field` of items into
+    `target`, keeping the raw values.
+    """
+    def normalize(item):
+        if item.get(field):
+            item[target] = normalize_item(item[field], plan)
+
+        return item
+
+    return Stage(normalize, 'normalize')
+
+
+def slug_stage(field='slug'):
+    """Stage setting the product slug of items with brand & model."""
+    def slug(item):
+        if item.get('marca') and item.get('modelo'):
+            item[field] = create_product_slug(item)
+
+        return item
+
+    return Stage(slug, 'slug')
+
+
+def tracking_stage(
+    field='tracker_link',
+    url_field='url',
+    store_field='empresa',
+):
+    """Stage setting the tracker link of items from tracked stores."""
+    def tracking(item):
+        store = item.get(store_field)
+
+        if store in STORE_URL_MAP and item.get(url_field):
+            item[field] = get_tracker_link(item[url_field], store)
+
+        return item
+
+    return Stage(tracking, 'tracking')
+
+
+def read_jsonl(path):
+    """Lazily read items from a JSON lines file."""
+    with open(path, 'r') as fp:
+        for line in fp:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_jsonl(items, path):
+    """Write items to a JSON lines file, returning how many."""
+    count = 0
+
+    with open(path, 'w') as fp:
+        for item in items:
+            fp.write(json.dumps(item, ensure_ascii=False))
+            fp.write('\n')
+            count += 1
+
+    return count
+
+
+def read_redis(key=None, client=None):
+    """Lazily pop items from a redis list until it's empty."""
+    from muyshopper.utils import redis_db
+
+    client = client or redis_db.get_redis_client()
+    key = key or redis_db.DEFAULT_KEY
+
+    while True:
+        item = client.lpop(key)
+
+        if item is None:
+            return
+
+        yield json.loads(item)
+
+
+def write_redis(items, key=None, client=None, batch_size=REDIS_BATCH_SIZE):
+    """Push items to a redis list in batches, returning how many."""
+    from muyshopper.utils import redis_db
+
+    client = client or redis_db.get_redis_client()
+    key = key or redis_db.DEFAULT_KEY
+    count = 0
+
+    for chunk in chunked(items, batch_size):
+        client.rpush(key, *(json.dumps(item) for item in chunk))
+        count += len(chunk)
+
+    return count
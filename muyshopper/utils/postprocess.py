@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """Utils to process all item fields and attributes."""
-import re
+from muyshopper.utils.normalization import find_number_in_string
 
 
 class PostProcess:
@@ -8,31 +8,11 @@ class PostProcess:
         pass
 
     def find_float_in_string(self, value, limit=None, keep_right_zeros=True):
-        if value:
-            if '.' in value and ',' in value:
-                value = value.replace('.', '')
-            else:
-                value = value.replace(',', '.')
-        
-            value = str(value).lower()
-
-            try:
-                value = value.replace(',', '.')
-                number = re.findall(r"[-+]?\d*\.\d+|\d+", value)[0]
-                # number = re.findall(r"\d+\.\d+", value)[0] # ONLY FLOAT, NO INT
-
-                number = float(number)
-
-                if not keep_right_zeros:
-                    if float(number) % 1 == 0:
-                        number = int(number)
-
-                if limit and number > limit:
-                    return None
-
-                return number
-            except IndexError:
-                return None
+        return find_number_in_string(
+            value,
+            limit=limit,
+            keep_right_zeros=keep_right_zeros,
+        )
 
     def process_item(self, item):
         price = item.get('precio')
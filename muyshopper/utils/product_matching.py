@@ -1,111 +1,583 @@
 """Matching utils."""
 import os
+import re
 import json
-import pickle
+import time
+import multiprocessing
+
+from collections import Counter
+
+from muyshopper.utils.catalog import get_catalog
+from muyshopper.utils.keywords import KeywordMatcher
+from muyshopper.utils.text import ItemTextCache, lowercase
+
+
+# Items matched by a worker process before it is replaced
+MATCH_CHUNK_SIZE = 5000
+
+# Matcher and items shared with forked workers
+_batch = None
+
+# Characters ignored by fuzzy matching
+NON_ALPHANUMERIC_RE = re.compile(r'[\W_]+')
+
+# Character n-gram size of the fuzzy index
+NGRAM_SIZE = 3
+
+# Min share of the n-grams of a brand or model that a title must contain
+FUZZY_THRESHOLD = 0.8
+
+
+def _match_chunk(index):
+    """Match a chunk of the shared items, starting from the parent state."""
+    matcher, items, chunk_size = _batch
+
+    matcher.marcas_learned = []
+    matcher.modelos_learned = []
+    matcher.reset_stats()
+
+    chunk = items[index * chunk_size:(index + 1) * chunk_size]
+    results = [matcher.match_product(item) for item in chunk]
+
+    return (
+        results,
+        matcher.marcas_learned,
+        matcher.modelos_learned,
+        matcher.match_stats,
+    )
+
+
+class MatchStats:
+    """Counters and cumulative timings of matching stages."""
+
+    def __init__(self):
+        """Initialize variables."""
+        self.counters = Counter()
+        self.seconds = Counter()
+        self.brand_hits = Counter()
+        self.brand_seconds = Counter()
+
+    def stage(self, stage, start, hit=None):
+        """Count a stage run since `start` and return the current time."""
+        now = time.perf_counter()
+
+        self.counters[stage] += 1
+        self.seconds[stage] += now - start
+
+        if hit:
+            self.counters[stage + '_hits'] += 1
+
+        return now
+
+    def item(self, marca, start, end):
+        """Count a matched item and its brand."""
+        self.counters['items'] += 1
+        self.seconds['items'] += end - start
+
+        if marca:
+            self.brand_hits[marca] += 1
+            self.brand_seconds[marca] += end - start
+
+    def merge(self, other):
+        """Add the counters and timings of other stats."""
+        self.counters.update(other.counters)
+        self.seconds.update(other.seconds)
+        self.brand_hits.update(other.brand_hits)
+        self.brand_seconds.update(other.brand_seconds)
+
+    def as_dict(self):
+        """Get stats as a dict, brands sorted by hits."""
+        return {
+            'counters': dict(self.counters),
+            'seconds': dict(self.seconds),
+            'brands': {
+                marca: {
+                    'hits': hits,
+                    'seconds': self.brand_seconds[marca],
+                }
+                for marca, hits in self.brand_hits.most_common()
+            },
+        }
+
+
+def compact(text):
+    """Lowercase a text and drop spaces, hyphens and punctuation."""
+    return NON_ALPHANUMERIC_RE.sub('', text.lower())
+
+
+class NGramIndex:
+    """
+    Character n-gram inverted index for fuzzy lookups.
+
+    Keys and texts are compared compacted, so spacing and punctuation
+    variants ("galaxy s 9", "iphone-x") share all their n-grams, and a
+    typo only loses the few n-grams around it. `find` only scores the
+    keys sharing at least one n-gram with the text, found through the
+    posting lists of the text n-grams, so its cost depends on the text
+    and not on the number of keys.
+    """
+
+    def __init__(self, keys=(), n=NGRAM_SIZE):
+        """Initialize variables."""
+        self.n = n
+        self.keys = []
+        self.sizes = []
+        self.postings = {}
+        self.members = set()
+
+        for key in keys:
+            self.add(key)
+
+    def ngrams(self, text):
+        """Get the set of n-grams of a compacted text."""
+        return {
+            text[index:index + self.n]
+            for index in range(len(text) - self.n + 1)
+        }
+
+    def add(self, key):
+        """Index a key, keys shorter than `n` once compacted are skipped."""
+        if key in self.members:
+            return
+
+        self.members.add(key)
+        grams = self.ngrams(compact(key))
+
+        if not grams:
+            return
+
+        key_id = len(self.keys)
+        self.keys.append(key)
+        self.sizes.append(len(grams))
+
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(key_id)
+
+    def find(self, text, threshold=FUZZY_THRESHOLD):
+        """
+        Find the key with the highest share of its n-grams in text, at
+        least `threshold`. Ties go to the longest key, then the first one.
+        """
+        shared = Counter()
+
+        for gram in self.ngrams(compact(text)):
+            key_ids = self.postings.get(gram)
+
+            if key_ids:
+                shared.update(key_ids)
+
+        best = None
+        best_rank = None
+
+        for key_id, count in shared.items():
+            score = count / self.sizes[key_id]
+
+            if score >= threshold:
+                rank = (-score, -len(self.keys[key_id]), key_id)
+
+                if best_rank is None or rank < best_rank:
+                    best = self.keys[key_id]
+                    best_rank = rank
+
+        return best
+
+
+class BrandModels:
+    """Models of a brand, with O(1) membership and a title index."""
+
+    def __init__(self, models):
+        """Wrap the list of models of a brand, which is kept in sync."""
+        self.models = models
+        self.members = set(models)
+        self.index = None
+        self.fuzzy_index = None
+
+    def __contains__(self, modelo):
+        """Check if the brand has a model."""
+        return modelo in self.members
+
+    def add(self, modelo):
+        """Append a model to the brand."""
+        self.models.append(modelo)
+        self.members.add(modelo)
+
+        if self.index is not None and modelo:
+            self.index.add(modelo)
+
+        if self.fuzzy_index is not None and modelo:
+            self.fuzzy_index.add(modelo)
+
+    def find(self, title):
+        """Find the longest model of the brand present in a title."""
+        if self.index is None:
+            self.index = KeywordMatcher(
+                filter(None, self.models),
+                longest_first=True,
+            )
+
+        return self.index.find(title)
+
+    def find_fuzzy(self, title, threshold=FUZZY_THRESHOLD):
+        """Find the model of the brand most similar to part of a title."""
+        if self.fuzzy_index is None:
+            self.fuzzy_index = NGramIndex(filter(None, self.models))
+
+        return self.fuzzy_index.find(title, threshold)
 
 
 class ProductMatcher:
     """Match item with specific product's brand & model."""
 
-    def __init__(self, pickle_path, skip_brands_path, normalized_brands_path):
-        """Variable initialization."""
+    def __init__(
+        self,
+        pickle_path,
+        skip_brands_path,
+        normalized_brands_path,
+        brands_reload_interval=None,
+        catalog=None,
+        fuzzy_threshold=None,
+        collect_stats=False,
+    ):
+        """
+        Variable initialization. With `brands_reload_interval` set, the
+        normalized brands file is checked for changes at most once every
+        that many seconds and reloaded when modified. Brands & models are
+        stored in `catalog`, by default the backend matching `pickle_path`
+        (SQLite for `.db`/`.sqlite` files, pickle otherwise). With
+        `fuzzy_threshold` set, brands & models not found as such in the
+        title are looked up in n-gram indexes, see `NGramIndex`. With
+        `collect_stats` set, matching paths are counted and timed, see
+        `stats`
+        """
         self.pickle_path = pickle_path
+        self.catalog = catalog or get_catalog(pickle_path)
+        self.fuzzy_threshold = fuzzy_threshold
+        self.collect_stats = collect_stats
         self.normalized_brands_path = normalized_brands_path
+        self.brands_reload_interval = brands_reload_interval
 
         with open(skip_brands_path, 'r') as fp:
             self.skip_data = json.load(fp)
 
+        self.load_normalized_brands()
+
         self.data = self.load_data()
+        self.marcas_index = KeywordMatcher(
+            filter(None, self.data),
+            longest_first=True,
+        )
+        self.modelos = {}
+        self.marcas_fuzzy_index = None
+
+        # Brands & `(brand, model)` pairs learned since the last save
+        self.marcas_learned = []
+        self.modelos_learned = []
+
+        self.last_batch_stats = None
+        self.reset_stats()
 
+    def reset_stats(self):
+        """Reset matching counters and timings, and the added counts."""
+        self.match_stats = MatchStats()
         self.marcas_added = 0
         self.modelos_added = 0
 
+    def stats(self):
+        """
+        Get matching stats: how many times each stage ran and hit, the
+        seconds spent in it, and the items and seconds of every brand.
+        Stages are `learn` (skip lists and adding the item brand & model,
+        with `skip_marca`/`skip_modelo`/`marca_from_item`/`modelo_from_item`
+        counters), `match_marca` and `match_modelo` (from the title, with
+        `*_fuzzy_hits` counters) and `normalize_marca` (hit when the brand
+        changed). `marcas_added` and `modelos_added` count the brands &
+        models learned, all since the last `reset_stats`.
+        """
+        stats = self.match_stats.as_dict()
+        stats['marcas_added'] = self.marcas_added
+        stats['modelos_added'] = self.modelos_added
+
+        return stats
+
     def load_data(self):
-        """Load data from pickle file."""
-        with open(self.pickle_path, 'rb') as fp:
-            data = pickle.load(fp)
+        """Load data from the catalog."""
+        return self.catalog.load()
+
+    def load_normalized_brands(self):
+        """Load normalized brands as an `ALIAS -> normalized brand` map."""
+        mtime = os.path.getmtime(self.normalized_brands_path)
+        self.brands_checked_at = time.monotonic()
 
-        return data
+        with open(self.normalized_brands_path, 'r') as fp:
+            brands = json.load(fp)
+
+        # First normalized brand listing an alias wins, as when scanning
+        brand_aliases = {}
+
+        for normalized_brand, alternatives in brands.items():
+            for alternative in alternatives:
+                brand_aliases.setdefault(
+                    alternative.upper(),
+                    normalized_brand.lower(),
+                )
+
+        self.brand_aliases = brand_aliases
+        self.brands_mtime = mtime
+
+    def reload_normalized_brands(self):
+        """Reload normalized brands if their file changed."""
+        now = time.monotonic()
+
+        if now - self.brands_checked_at < self.brands_reload_interval:
+            return
+
+        self.brands_checked_at = now
+
+        # The file may be missing or half written while being replaced,
+        # the current aliases are kept until the next check
+        try:
+            mtime = os.path.getmtime(self.normalized_brands_path)
+
+            if mtime != self.brands_mtime:
+                self.load_normalized_brands()
+        except (OSError, ValueError):
+            pass
+
+    def normalize_marca(self, marca):
+        """Get the normalized name of a brand."""
+        if self.brands_reload_interval is not None:
+            self.reload_normalized_brands()
+
+        return self.brand_aliases.get(marca.upper(), marca)
+
+    def get_modelos(self, marca):
+        """Get the models of a brand."""
+        modelos = self.modelos.get(marca)
+
+        if modelos is None:
+            modelos = self.modelos[marca] = BrandModels(self.data[marca])
+
+        return modelos
 
     def match_product(self, item):
         """Match item with a specific brand & model product."""
+        stats = self.match_stats if self.collect_stats else None
+
+        if stats:
+            start = last = time.perf_counter()
+
         item['marca'] = item['marca'].lower().strip() \
             if item['marca'] else None
 
         item['modelo'] = item['modelo'].lower().strip() \
             if item['modelo'] else None
 
+        if stats:
+            marca, modelo = item['marca'], item['modelo']
+
         self.add_marca_modelo(item)
 
+        if stats:
+            last = stats.stage('learn', last)
+            self.count_learned(item, marca, modelo)
+
+        texts = ItemTextCache(lowercase)
+
         if item['marca'] is None:
-            item = self.match_marca(item)
+            item = self.match_marca(item, texts)
+
+            if stats:
+                last = stats.stage(
+                    'match_marca', last, item['marca'] is not None,
+                )
 
         if item['modelo'] is None:
-            item = self.match_modelo(item)
+            item = self.match_modelo(item, texts)
 
-        if not item['marca'] or not item['modelo']:
-            pass
-        else:
-            with open(self.normalized_brands_path, 'r') as fp:
-                brands = json.load(fp)
+            if stats:
+                last = stats.stage(
+                    'match_modelo', last, item['modelo'] is not None,
+                )
+
+        if item['marca'] and item['modelo']:
+            marca = item['marca']
+            item['marca'] = self.normalize_marca(marca)
+
+            if stats:
+                last = stats.stage(
+                    'normalize_marca', last, item['marca'] != marca,
+                )
 
-                for normalized_brand, alternatives in brands.items():
-                    if item['marca'].upper() in alternatives:
-                        item['marca'] = normalized_brand.lower()
-                        break
+        if stats:
+            stats.item(item['marca'], start, last)
 
         return item
 
-    def match_marca(self, item):
+    def count_learned(self, item, marca, modelo):
+        """Count skip list hits and brand & model taken from the item."""
+        counters = self.match_stats.counters
+
+        if marca is not None and item['marca'] is None:
+            counters['skip_marca'] += 1
+        elif modelo is not None and item['modelo'] is None:
+            counters['skip_modelo'] += 1
+
+        if item['marca'] is not None:
+            counters['marca_from_item'] += 1
+
+        if item['modelo'] is not None:
+            counters['modelo_from_item'] += 1
+
+    def match_products(self, items, workers=None, chunk_size=MATCH_CHUNK_SIZE):
+        """
+        Match a batch of items, returned in the same order.
+
+        With `workers`, chunks of items are matched in forked processes.
+        Every chunk starts from the brands & models known before the batch
+        and the ones it learns are merged back in chunk order, so results
+        don't depend on scheduling, but an item can't use what another
+        chunk learned. Items are updated in place either way.
+        """
+        global _batch
+
+        items = list(items)
+        start = time.perf_counter()
+
+        if not workers or workers < 2 or len(items) <= chunk_size:
+            workers = 1
+            results = [self.match_product(item) for item in items]
+        else:
+            chunks = range((len(items) + chunk_size - 1) // chunk_size)
+            context = multiprocessing.get_context('fork')
+
+            _batch = self, items, chunk_size
+
+            try:
+                # One chunk per process, so that each one is forked from the
+                # untouched parent state
+                with context.Pool(workers, maxtasksperchild=1) as pool:
+                    chunk_results = pool.map(_match_chunk, chunks, 1)
+            finally:
+                _batch = None
+
+            results = []
+
+            for chunk, marcas, modelos, match_stats in chunk_results:
+                results.extend(chunk)
+                self.match_stats.merge(match_stats)
+
+                for marca in marcas:
+                    self.learn_marca(marca)
+
+                for marca, modelo in modelos:
+                    self.learn_modelo(marca, modelo)
+
+            for item, result in zip(items, results):
+                item.update(result)
+
+            results = items
+
+        elapsed = time.perf_counter() - start
+
+        self.last_batch_stats = {
+            'items': len(items),
+            'workers': workers,
+            'seconds': elapsed,
+            'items_per_second': len(items) / elapsed if elapsed else 0,
+        }
+
+        return results
+
+    def match_marca(self, item, texts=None):
         """Try to match product's brand from it's title."""
         title = item['title']
-        marcas = self.data
-        marcas = filter(None, marcas)
 
         if title:
-            for marca in sorted(marcas, key=len, reverse=True):
-                if marca in title.lower():
-                    item['marca'] = marca
-                    return item
+            title = (texts or ItemTextCache(lowercase)).get(title)
+            marca = self.marcas_index.find(title)
+
+            if marca is None and self.fuzzy_threshold is not None:
+                marca = self.find_fuzzy_marca(title)
+
+                if marca is not None and self.collect_stats:
+                    self.match_stats.counters['match_marca_fuzzy_hits'] += 1
+
+            if marca is not None:
+                item['marca'] = marca
 
         return item
 
-    def match_modelo(self, item):
+    def match_modelo(self, item, texts=None):
         """Try to match product's model name from it's title."""
         title = item['title']
 
-        if item['marca'] is not None:
-            modelos = self.data[item['marca']]
-            modelos = filter(None, modelos)
+        if item['marca'] is not None and title:
+            title = (texts or ItemTextCache(lowercase)).get(title)
+            modelos = self.get_modelos(item['marca'])
+            modelo = modelos.find(title)
+
+            if modelo is None and self.fuzzy_threshold is not None:
+                modelo = modelos.find_fuzzy(title, self.fuzzy_threshold)
 
-            for modelo in sorted(modelos, key=len, reverse=True):
-                if modelo in title.lower():
-                    item['modelo'] = modelo
-                    return item
+                if modelo is not None and self.collect_stats:
+                    self.match_stats.counters['match_modelo_fuzzy_hits'] += 1
+
+            if modelo is not None:
+                item['modelo'] = modelo
 
         return item
 
+    def find_fuzzy_marca(self, title):
+        """Find the brand most similar to part of a title."""
+        if self.marcas_fuzzy_index is None:
+            self.marcas_fuzzy_index = NGramIndex(filter(None, self.data))
+
+        return self.marcas_fuzzy_index.find(title, self.fuzzy_threshold)
+
     def add_marca_modelo(self, item):
-        """Add brand & model to pickle file."""
+        """Add brand & model to the catalog."""
         if item['marca'] in self.skip_data['brands']:
             item['marca'] = None
             item['modelo'] = None
 
-        if item['marca'] not in self.data:
-            if item['marca'] is not None:
-                self.data[item['marca']] = []
-                self.marcas_added += 1
-
         if item['marca'] is not None:
+            self.learn_marca(item['marca'])
+
             if item['modelo'] in self.skip_data['models']:
                 item['modelo'] = None
 
-            if item['modelo'] not in self.data[item['marca']]:
-                if item['modelo'] is not None:
-                    self.data[item['marca']].append(item['modelo'])
-                    self.modelos_added += 1
+            if item['modelo'] is not None:
+                self.learn_modelo(item['marca'], item['modelo'])
+
+    def learn_marca(self, marca):
+        """Add a brand if it's new."""
+        if marca not in self.data:
+            self.data[marca] = []
+            self.marcas_added += 1
+            self.marcas_learned.append(marca)
+
+            if marca:
+                self.marcas_index.add(marca)
+
+                if self.marcas_fuzzy_index is not None:
+                    self.marcas_fuzzy_index.add(marca)
+
+    def learn_modelo(self, marca, modelo):
+        """Add a model of a known brand if it's new."""
+        modelos = self.get_modelos(marca)
+
+        if modelo not in modelos:
+            modelos.add(modelo)
+            self.modelos_added += 1
+            self.modelos_learned.append((marca, modelo))
 
     def save(self):
-        """Save data to pickle file."""
-        with open(self.pickle_path, 'wb') as fp:
-            pickle.dump(self.data, fp)
+        """Save brands & models learned since the last save."""
+        self.catalog.save(
+            self.data,
+            self.marcas_learned,
+            self.modelos_learned,
+        )
+
+        self.marcas_learned = []
+        self.modelos_learned = []
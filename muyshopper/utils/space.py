@@ -1,78 +1,134 @@
 """Space utils."""
 import os
+import threading
+import warnings
+
 import boto3
 
+from botocore.config import Config
+
+from muyshopper.utils.manifest import Entry, Manifest
 
-# S3 settings
-S3_REGION_NAME = 'nyc3'
-S3_SPACE_NAME = 'mmuu-data'
-S3_ENDPOINT_URL = 'https://nyc3.digitaloceanspaces.com'
+
+# S3 settings, the environment can point them to a local stand-in
+S3_REGION_NAME = os.getenv('S3_REGION_NAME', 'nyc3')
+S3_SPACE_NAME = os.getenv('S3_SPACE_NAME', 'mmuu-data')
+S3_ENDPOINT_URL = os.getenv(
+    'S3_ENDPOINT_URL', 'https://nyc3.digitaloceanspaces.com',
+)
 S3_ACCESS_ID = os.getenv('S3_ACCESS_ID')
 S3_SECRET_KEY = os.getenv('S3_SECRET_KEY')
+S3_SPACE_URL = os.getenv(
+    'S3_SPACE_URL', 'https://mmuu-data.nyc3.digitaloceanspaces.com/',
+)
+
+# S3 client settings
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 32))
+S3_CONNECT_TIMEOUT = 10
+S3_READ_TIMEOUT = 60
+S3_MAX_ATTEMPTS = 5
 S3_IMAGES_PATH = 'img/big/'
 S3_THUMBNAILS_PATH = 'img/thumb/'
 
 
-# Local paths
+# Local paths, the lists are legacy
 IMAGES_LIST_PATH = '/tmp/images.txt'
 THUMBNAILS_LIST_PATH = '/tmp/thumbnails.txt'
-
-
-def get_images_list(prefix=S3_IMAGES_PATH):
-    """Get a list of images of products present in the Space."""
-    session = boto3.session.Session()
-
-    client = session.client(
-        's3',
-        region_name=S3_REGION_NAME,
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=S3_ACCESS_ID,
-        aws_secret_access_key=S3_SECRET_KEY
+MANIFEST_PATH = '/tmp/space-manifest.tsv'
+
+# Prefixes listed in the manifest
+MANIFEST_PREFIXES = (S3_IMAGES_PATH, S3_THUMBNAILS_PATH)
+
+# Seconds before the manifest is refreshed when read
+MANIFEST_MAX_AGE = 60 * 60
+
+# Shared by every function of this module
+space_manifest = Manifest(MANIFEST_PATH)
+
+# Clients by process and settings, see get_s3_client
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_s3_client(max_pool_connections=None):
+    """
+    Get the S3 client of the current process for the current settings,
+    created on first use. Clients are thread safe and keep a pool of
+    connections, so they are shared by every thread. A forked process
+    creates its own, connections of the parent are never reused.
+    """
+    pid = os.getpid()
+    settings = (
+        pid,
+        S3_REGION_NAME,
+        S3_ENDPOINT_URL,
+        S3_ACCESS_ID,
+        S3_SECRET_KEY,
+        max_pool_connections or S3_MAX_POOL_CONNECTIONS,
     )
 
-    image_links = []
+    client = _clients.get(settings)
+
+    if client is not None:
+        return client
+
+    with _clients_lock:
+        if settings not in _clients:
+            for other in [key for key in _clients if key[0] != pid]:
+                del _clients[other]
+
+            # Sessions aren't thread safe, each client gets its own
+            session = boto3.session.Session()
+
+            _clients[settings] = session.client(
+                's3',
+                region_name=S3_REGION_NAME,
+                endpoint_url=S3_ENDPOINT_URL,
+                aws_access_key_id=S3_ACCESS_ID,
+                aws_secret_access_key=S3_SECRET_KEY,
+                config=Config(
+                    max_pool_connections=settings[-1],
+                    connect_timeout=S3_CONNECT_TIMEOUT,
+                    read_timeout=S3_READ_TIMEOUT,
+                    retries={
+                        'total_max_attempts': S3_MAX_ATTEMPTS,
+                        'mode': 'standard',
+                    },
+                ),
+            )
 
-    # Create a reusable Paginator
-    paginator = client.get_paginator('list_objects')
+        return _clients[settings]
 
-    # Create a PageIterator from the Paginator
-    page_iterator = paginator.paginate(Bucket=S3_SPACE_NAME, Prefix=prefix)
 
-    for page in page_iterator:
-        for obj in page['Contents']:
-            image_links.append(
-                'https://mmuu-data.nyc3.digitaloceanspaces.com/' +
-                obj['Key']
-            )
+def iter_objects(prefix=S3_IMAGES_PATH, start_after=None):
+    """Lazily get the entries of keys with prefix, sorted by key."""
+    client = get_s3_client()
 
-    return image_links
+    paginator = client.get_paginator('list_objects_v2')
 
+    kwargs = {'Bucket': S3_SPACE_NAME, 'Prefix': prefix}
 
-def get_prefix_keys(prefix=S3_IMAGES_PATH):
-    """Get a list of keys present in the Space with prefix."""
-    session = boto3.session.Session()
-
-    client = session.client(
-        's3',
-        region_name=S3_REGION_NAME,
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=S3_ACCESS_ID,
-        aws_secret_access_key=S3_SECRET_KEY
-    )
+    if start_after:
+        kwargs['StartAfter'] = start_after
 
-    image_links = []
+    for page in paginator.paginate(**kwargs):
+        for obj in page.get('Contents', []):
+            yield Entry(
+                obj['Key'],
+                obj['Size'],
+                obj['ETag'].strip('"'),
+                int(obj['LastModified'].timestamp()),
+            )
 
-    # Create a reusable Paginator
-    paginator = client.get_paginator('list_objects')
 
-    # Create a PageIterator from the Paginator
-    page_iterator = paginator.paginate(Bucket=S3_SPACE_NAME, Prefix=prefix)
+def get_images_list(prefix=S3_IMAGES_PATH):
+    """Get a list of images of products present in the Space."""
+    return [S3_SPACE_URL + entry.key for entry in iter_objects(prefix)]
 
-    for page in page_iterator:
-        for obj in page['Contents']:
-            image_links.append(obj['Key'])
 
-    return image_links
+def get_prefix_keys(prefix=S3_IMAGES_PATH):
+    """Get a list of keys present in the Space with prefix."""
+    return [entry.key for entry in iter_objects(prefix)]
 
 
 def get_thumbnails_list():
@@ -83,7 +139,10 @@ def get_thumbnails_list():
 
 
 def download_images_list(filename=IMAGES_LIST_PATH):
-    """Download a list of images of products present in the Space."""
+    """
+    Download a list of images of products present in the Space. Legacy,
+    only read when its filename is passed to `read_images_list`.
+    """
     image_links = get_images_list()
 
     with open(filename, 'w') as fp:
@@ -91,8 +150,11 @@ def download_images_list(filename=IMAGES_LIST_PATH):
 
 
 def download_thumbnails_list(filename=THUMBNAILS_LIST_PATH):
-    """Download a list of thumbnails of products present in the Space."""
-    image_links = get_images_list()
+    """
+    Download a list of thumbnails of products present in the Space.
+    Legacy, like `download_images_list`.
+    """
+    image_links = get_thumbnails_list()
 
     with open(filename, 'w') as fp:
         fp.write('\n'.join(image_links))
@@ -100,15 +162,7 @@ def download_thumbnails_list(filename=THUMBNAILS_LIST_PATH):
 
 def upload_file_to_s3(local_path, s3_path, metadata=None):
     """Upload file to the DigitalOcean space."""
-    session = boto3.session.Session()
-
-    client = session.client(
-        's3',
-        region_name=S3_REGION_NAME,
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=S3_ACCESS_ID,
-        aws_secret_access_key=S3_SECRET_KEY
-    )
+    client = get_s3_client()
 
     if metadata:
         extra_args = {
@@ -127,75 +181,308 @@ def upload_file_to_s3(local_path, s3_path, metadata=None):
         ExtraArgs=extra_args
     )
 
+    record_upload(s3_path, size=os.path.getsize(local_path))
+
+    return os.path.join(S3_ENDPOINT_URL, s3_path)
+
+
+def upload_fileobj_to_s3(fileobj, s3_path, metadata=None, content_type=None):
+    """Upload an in-memory file to the DigitalOcean space."""
+    client = get_s3_client()
+
+    if metadata:
+        extra_args = {
+            'ACL': 'public-read',
+            'Metadata': metadata
+        }
+    else:
+        extra_args = {
+            'ACL': 'public-read',
+        }
+
+    if content_type:
+        extra_args['ContentType'] = content_type
+
+    client.upload_fileobj(
+        fileobj,
+        S3_SPACE_NAME,
+        s3_path,
+        ExtraArgs=extra_args
+    )
+
+    record_upload(s3_path)
+
+    return os.path.join(S3_ENDPOINT_URL, s3_path)
+
+
+def copy_s3_object(source_path, s3_path):
+    """Copy an object of the DigitalOcean space to another key."""
+    client = get_s3_client()
+
+    response = client.copy_object(
+        Bucket=S3_SPACE_NAME,
+        Key=s3_path,
+        CopySource={'Bucket': S3_SPACE_NAME, 'Key': source_path},
+        ACL='public-read',
+    )
+
+    record_upload(
+        s3_path,
+        etag=response['CopyObjectResult']['ETag'].strip('"'),
+    )
+
     return os.path.join(S3_ENDPOINT_URL, s3_path)
 
 
-def read_images_list(filename=IMAGES_LIST_PATH):
-    """Read image list from local file."""
+def refresh_manifest(full=False):
+    """
+    Update the space manifest with journaled uploads and new keys, or
+    list the whole space when `full` or due.
+    """
+    return space_manifest.refresh(iter_objects, MANIFEST_PREFIXES, full)
+
+
+def read_manifest(max_age=MANIFEST_MAX_AGE):
+    """Get the space manifest, refreshed if older than `max_age`."""
+    age = space_manifest.age()
+
+    if age is None or age > max_age:
+        refresh_manifest()
+
+    return space_manifest
+
+
+def read_list_file(filename, download):
+    """Read a local list of links, `download` it first if missing."""
+    warnings.warn(
+        'local lists are deprecated, call without a filename to read the '
+        'space manifest',
+        DeprecationWarning,
+        stacklevel=3,
+    )
+
     if not os.path.isfile(filename):
-        download_images_list()
+        download(filename)
 
     with open(filename, 'r') as fp:
-        images_list = fp.read().splitlines()
+        return fp.read().splitlines()
 
-    return images_list
 
+def read_images_list(filename=None, *, prefix=S3_IMAGES_PATH):
+    """
+    Read image list from the space manifest. Passing the `filename` of
+    a local list, downloaded if missing, is deprecated.
+    """
+    if filename is not None:
+        return read_list_file(filename, download_images_list)
 
-def read_thumbnails_list(filename=THUMBNAILS_LIST_PATH):
-    """Read thumbnail list from local file."""
-    if not os.path.isfile(filename):
-        download_thumbnails_list()
+    return [S3_SPACE_URL + key for key in read_manifest().keys(prefix)]
 
-    return read_images_list(filename=filename)
 
+def read_thumbnails_list(filename=None):
+    """
+    Read thumbnail list from the space manifest. Passing the `filename`
+    of a local list, downloaded if missing, is deprecated.
+    """
+    if filename is not None:
+        return read_list_file(filename, download_thumbnails_list)
 
-def get_product_images_in_space(slug):
-    """Retrieve product data of images and thumbnails on space."""
-    product_space_data = {
-        'images': [],
-        'thumbnails': [],
-    }
+    return read_images_list(prefix=S3_THUMBNAILS_PATH)
+
+
+def get_link_slug(link, prefix=S3_IMAGES_PATH):
+    """Get the product slug of a space link or key under prefix, or None."""
+    _, found, path = link.partition(prefix)
+
+    if not found:
+        return None
+
+    slug, found, name = path.partition('/')
+
+    # Folder placeholders have no name
+    if not found or not name:
+        return None
+
+    return slug
+
+
+def group_links_by_slug(links, prefix=S3_IMAGES_PATH):
+    """Group space links or keys under prefix by product slug."""
+    groups = {}
+
+    for link in links:
+        slug = get_link_slug(link, prefix)
+
+        if slug is not None:
+            groups.setdefault(slug, []).append(link)
+
+    return groups
+
+
+def get_link_store(link):
+    """Get the store name of a space image link or key."""
+    return os.path.basename(link).rsplit('-', 1)[0]
+
+
+class SpaceInventory:
+    """
+    Space images and thumbnails indexed by product slug.
+
+    The space manifest is read the first time the inventory is queried
+    and kept as per slug sets of links and store names, so lookups don't
+    depend on the number of images in the space. Uploads, copies and
+    deletions made through this module are recorded as they happen, so
+    the inventory stays current without listing the space again.
+    """
+
+    def __init__(self):
+        """Initialize variables."""
+        self.lock = threading.RLock()
+        self.loaded = False
+
+        self.images = {}
+        self.thumbnails = {}
+        self.stores = {}
+
+    def load(self):
+        """Read the space manifest, unless already read."""
+        with self.lock:
+            if self.loaded:
+                return
+
+            manifest = read_manifest()
+
+            for prefix in MANIFEST_PREFIXES:
+                for key in manifest.keys(prefix):
+                    self.add(key)
+
+            self.loaded = True
+
+    def reload(self):
+        """Forget every image and read the space manifest again."""
+        with self.lock:
+            self.images = {}
+            self.thumbnails = {}
+            self.stores = {}
+            self.loaded = False
+
+            self.load()
+
+    def add(self, link):
+        """Record a space link or key, folder placeholders are skipped."""
+        if '://' not in link:
+            link = S3_SPACE_URL + link
+
+        with self.lock:
+            slug = get_link_slug(link, S3_THUMBNAILS_PATH)
+
+            if slug is not None:
+                self.thumbnails.setdefault(slug, set()).add(link)
+                return
 
-    images_list = read_images_list()
+            slug = get_link_slug(link, S3_IMAGES_PATH)
 
-    product_images_list = [
-        img for img in images_list if slug + '/' in img
-    ]
+            if slug is not None:
+                self.images.setdefault(slug, set()).add(link)
+                self.stores.setdefault(slug, set()).add(get_link_store(link))
 
-    product_space_data['images'].extend(product_images_list)
+    def discard(self, link):
+        """Forget a space link or key."""
+        if '://' not in link:
+            link = S3_SPACE_URL + link
 
-    thumbnails_list = read_thumbnails_list()
+        with self.lock:
+            slug = get_link_slug(link, S3_THUMBNAILS_PATH)
 
-    product_thumbnail_list = [
-            img for img in thumbnails_list if slug + '/' in img
-    ]
+            if slug is not None:
+                self.thumbnails.get(slug, set()).discard(link)
+                return
 
-    product_space_data['thumbnails'].extend(product_thumbnail_list)
+            slug = get_link_slug(link, S3_IMAGES_PATH)
 
-    return product_space_data
+            if slug is None or link not in self.images.get(slug, ()):
+                return
+
+            self.images[slug].discard(link)
+            self.stores[slug] = {
+                get_link_store(image) for image in self.images[slug]
+            }
+
+    def images_for(self, slug):
+        """Get the sorted image links of a product."""
+        with self.lock:
+            if not self.loaded:
+                self.load()
+
+            # Copied, uploading threads add links while it's sorted
+            images = list(self.images.get(slug, ()))
+
+        return sorted(images)
+
+    def thumbnails_for(self, slug):
+        """Get the sorted thumbnail links of a product."""
+        with self.lock:
+            if not self.loaded:
+                self.load()
+
+            thumbnails = list(self.thumbnails.get(slug, ()))
+
+        return sorted(thumbnails)
+
+    def has_store(self, slug, store):
+        """Check if a product has images from a store."""
+        with self.lock:
+            if not self.loaded:
+                self.load()
+
+            return store.lower() in self.stores.get(slug, ())
+
+    def has_thumbnail(self, slug):
+        """Check if a product has a thumbnail."""
+        with self.lock:
+            if not self.loaded:
+                self.load()
+
+            return bool(self.thumbnails.get(slug))
+
+
+# Shared by every function of this module, loaded on first query
+space_inventory = SpaceInventory()
+
+
+def record_upload(s3_path, size=None, etag=None):
+    """Record an uploaded key in the space inventory and manifest."""
+    space_inventory.add(s3_path)
+    space_manifest.record(s3_path, size, etag)
+
+
+def record_delete(key):
+    """Record a deleted key in the space inventory and manifest."""
+    space_inventory.discard(key)
+    space_manifest.record_delete(key)
+
+
+def get_product_images_in_space(slug):
+    """Retrieve product data of images and thumbnails on space."""
+    return {
+        'images': space_inventory.images_for(slug),
+        'thumbnails': space_inventory.thumbnails_for(slug),
+    }
 
 
 def get_product_images_in_space_online(slug):
     """Get product images in space online."""
-    session = boto3.session.Session()
-
-    client = session.client(
-        's3',
-        region_name=S3_REGION_NAME,
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=S3_ACCESS_ID,
-        aws_secret_access_key=S3_SECRET_KEY
-    )
+    client = get_s3_client()
 
     keys = []
 
     prefix = os.path.join(S3_IMAGES_PATH, slug) + '/'
 
-    response = client.list_objects_v2(Bucket='mmuu-data', Prefix=prefix)
+    response = client.list_objects_v2(Bucket=S3_SPACE_NAME, Prefix=prefix)
 
     for item in response.get('Contents', []):
         keys.append(
-            'https://mmuu-data.nyc3.digitaloceanspaces.com/' + item['Key']
+            S3_SPACE_URL + item['Key']
         )
 
     return keys[1:]
@@ -203,48 +490,32 @@ def get_product_images_in_space_online(slug):
 
 def get_product_images_in_space_count(slug):
     """Retrieve count of product images in the space."""
-    return len(get_product_images_in_space(slug)['images'])
+    return len(space_inventory.images_for(slug))
 
 
 def store_images_in_space(slug, store):
     """Check if store images of a product are already in the space."""
-    product_images = get_product_images_in_space(slug)['images']
-
-    store = store.lower()
-
-    for image in product_images:
-        if store in image:
-            return True
-
-    return False
+    return space_inventory.has_store(slug, store)
 
 
 def has_thumbnail(slug):
     """Check if product has a thumbnail image."""
-    return len(get_product_images_in_space(slug)['thumbnails']) > 1
+    return space_inventory.has_thumbnail(slug)
 
 
 def has_thumbnail_online(slug):
     """Check if product has a thumbnail image online."""
-    session = boto3.session.Session()
-
-    client = session.client(
-        's3',
-        region_name=S3_REGION_NAME,
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=S3_ACCESS_ID,
-        aws_secret_access_key=S3_SECRET_KEY
-    )
+    client = get_s3_client()
 
     keys = []
 
     prefix = os.path.join(S3_THUMBNAILS_PATH, slug) + '/'
 
-    response = client.list_objects_v2(Bucket='mmuu-data', Prefix=prefix)
+    response = client.list_objects_v2(Bucket=S3_SPACE_NAME, Prefix=prefix)
 
     for item in response.get('Contents', []):
         keys.append(
-            'https://mmuu-data.nyc3.digitaloceanspaces.com/' + item['Key']
+            S3_SPACE_URL + item['Key']
         )
 
     return keys[1:]
@@ -259,21 +530,14 @@ def create_s3_path(slug, store, count, extension):
 
 def delete_s3_prefix(prefix):
     """Recursively delete S3 key with prefix."""
-    session = boto3.session.Session()
-
-    client = session.client(
-        's3',
-        region_name=S3_REGION_NAME,
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=S3_ACCESS_ID,
-        aws_secret_access_key=S3_SECRET_KEY
-    )
+    client = get_s3_client()
 
     files_to_delete = get_prefix_keys(prefix=prefix)
 
     for key in files_to_delete:
         print('delete {}'.format(key))
         client.delete_object(Bucket=S3_SPACE_NAME, Key=key)
+        record_delete(key)
 
 
 def download_file(key):
@@ -294,15 +558,7 @@ def download_file(key):
         print('Skipping.. {}'.format(key))
         return
 
-    session = boto3.session.Session()
-
-    client = session.client(
-        's3',
-        region_name=S3_REGION_NAME,
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=S3_ACCESS_ID,
-        aws_secret_access_key=S3_SECRET_KEY
-    )
+    client = get_s3_client()
 
     print('Downloading.. {}'.format(key))
 
@@ -0,0 +1,53 @@
+"""SQLite storage utils."""
+import os
+import sqlite3
+
+
+# Seconds a writer waits for other writers to release the database
+SQLITE_TIMEOUT = 60
+
+
+class SQLiteDatabase:
+    """
+    Base of stores kept in a SQLite database.
+
+    Each process gets its own connection, opened on first use in WAL
+    mode with `schema` applied, so stores can be shared with forked
+    workers and several processes can write concurrently.
+    """
+
+    schema = ''
+
+    # Whether the connection may only be used by the thread creating it
+    check_same_thread = True
+
+    def __init__(self, path, timeout=SQLITE_TIMEOUT):
+        """Variable initialization."""
+        self.path = path
+        self.timeout = timeout
+
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        """Leave the connection out when pickled."""
+        state = self.__dict__.copy()
+        state['_connection'] = None
+        state['_pid'] = None
+
+        return state
+
+    @property
+    def connection(self):
+        """Get a connection owned by the current process."""
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self.path,
+                timeout=self.timeout,
+                check_same_thread=self.check_same_thread,
+            )
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript(self.schema)
+            self._pid = os.getpid()
+
+        return self._connection
@@ -0,0 +1,58 @@
+"""Text canonicalization utils."""
+import os
+from functools import lru_cache
+from unidecode import unidecode
+
+
+# Max number of canonical texts kept in memory
+CANONICAL_CACHE_SIZE = int(os.getenv('CANONICAL_CACHE_SIZE', 65536))
+
+
+@lru_cache(maxsize=CANONICAL_CACHE_SIZE)
+def canonical(text):
+    """Lowercase a text and transliterate it to ASCII."""
+    return unidecode(text.lower())
+
+
+def lowercase(text):
+    """Lowercase a text, keeping accents."""
+    return text.lower()
+
+
+class ItemTextCache:
+    """Transform each text of a single item at most once."""
+
+    def __init__(self, func=canonical):
+        """Initialize variables."""
+        self.func = func
+        self.texts = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text):
+        """Get the transformed text."""
+        try:
+            value = self.texts[text]
+            self.hits += 1
+        except KeyError:
+            value = self.texts[text] = self.func(text)
+            self.misses += 1
+
+        return value
+
+
+def cache_stats():
+    """Get hit/miss counters of the shared canonical cache."""
+    info = canonical.cache_info()
+
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'size': info.currsize,
+        'max_size': info.maxsize,
+    }
+
+
+def clear_cache():
+    """Empty the shared canonical cache and reset its counters."""
+    canonical.cache_clear()